@@ -0,0 +1,411 @@
+"""
+Benchmarks for WEmail against big synthetic maildirs.
+
+Generate a maildir to poke at by hand:
+
+    python benchmarks.py generate /tmp/bigmail --count 100000
+
+Or run the whole suite, which generates a fresh maildir per size:
+
+    python benchmarks.py run --sizes 1000 10000 100000 1000000
+
+Every command is timed in a fresh process, so that peak RSS is for that
+command alone. If ``strace`` is installed, syscalls are counted too.
+The ``baseline`` row is the cost of just starting Python and importing
+wemail, which is included in every other row.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from email.utils import format_datetime
+from pathlib import Path
+from unittest import mock
+
+import wemail
+
+COMMANDS = (
+    "baseline",
+    "list-cold",
+    "list",
+    "read",
+    "read-wrap",
+    "check",
+    "save",
+    "remove",
+    "send_all",
+)
+DEFAULT_SIZES = (1000, 10000)
+OUTBOX_COUNT = 100
+NEW_COUNT = 100
+LOG_SIZE = 10_000_000
+# Weights for the kinds of message that get generated.
+MESSAGE_KINDS = {
+    "plain": 50,
+    "quoted-printable": 15,
+    "alternative": 20,
+    "attachment": 15,
+}
+ATTACHMENT_SIZES = (10_000, 50_000, 200_000)
+WORDS = (
+    "the quick brown fox jumps over lazy dog email server meeting report "
+    "please find attached thanks regards hello world invoice schedule "
+    "update project release python maildir wemail déjà vu naïve café"
+).split()
+
+
+def _words(rng, count):
+    return " ".join(rng.choice(WORDS) for _ in range(count))
+
+
+def _paragraphs(rng, count):
+    return "\n\n".join(_words(rng, rng.randint(20, 80)) for _ in range(count))
+
+
+def _make_bodies(rng):
+    """
+    Return a dict of kind -> list of pre-rendered body variants. Each
+    variant is the MIME headers and body that follow the per-message
+    headers, so generating a message is just string formatting.
+    """
+    bodies = {kind: [] for kind in MESSAGE_KINDS}
+    for _ in range(5):
+        text = _paragraphs(rng, rng.randint(1, 6))
+        bodies["plain"].append(
+            "MIME-Version: 1.0\n"
+            'Content-Type: text/plain; charset="utf-8"\n'
+            "Content-Transfer-Encoding: 8bit\n\n" + text + "\n"
+        )
+        msg = wemail.EmailMessage(policy=wemail.POLICY)
+        msg.set_content(text, cte="quoted-printable")
+        bodies["quoted-printable"].append(msg.as_string())
+
+        msg = wemail.EmailMessage(policy=wemail.POLICY)
+        msg.set_content(text)
+        msg.add_alternative(
+            "".join(f"<p>{p}</p>" for p in text.split("\n\n")), subtype="html"
+        )
+        bodies["alternative"].append(msg.as_string())
+
+    for size in ATTACHMENT_SIZES:
+        msg = wemail.EmailMessage(policy=wemail.POLICY)
+        msg.set_content(_paragraphs(rng, 2))
+        msg.add_attachment(
+            rng.randbytes(size) if hasattr(rng, "randbytes") else os.urandom(size),
+            maintype="application",
+            subtype="octet-stream",
+            filename=f"attachment-{size}.bin",
+        )
+        bodies["attachment"].append(msg.as_string())
+    return bodies
+
+
+def _message_headers(rng, i, *, start):
+    date = start + rng.randint(0, 10 * 365 * 24 * 3600)
+    sent = wemail.datetime.fromtimestamp(date, wemail.timezone.utc)
+    return (
+        f"Date: {format_datetime(sent)}\n"
+        f"From: Sender {i % 97} <sender{i % 97}@example.com>\n"
+        f"To: Bench Mark <bench@example.com>\n"
+        f"Subject: {_words(rng, rng.randint(2, 8))} #{i}\n"
+        f"Message-ID: <{i}.{date}@bench.example.com>\n"
+    )
+
+
+def generate_messages(folder, *, count, seed=42, prefix="bench"):
+    """
+    Write ``count`` synthetic messages into ``folder``, with a realistic
+    mix of plain, quoted-printable, multipart/alternative, and base64
+    attachment messages.
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    bodies = _make_bodies(rng)
+    kinds = list(MESSAGE_KINDS)
+    weights = [MESSAGE_KINDS[kind] for kind in kinds]
+    start = 1_262_304_000  # 2010-01-01
+    for i in range(count):
+        (kind,) = rng.choices(kinds, weights)
+        body = rng.choice(bodies[kind])
+        mailfile = folder / f"{start + i}.{prefix}{i}.bench.eml"
+        mailfile.write_text(_message_headers(rng, i, start=start) + body)
+
+
+def generate_log_message(folder, *, size=LOG_SIZE, seed=42):
+    """
+    Write a message with a ``size`` byte log inline as its body - long
+    lines, URLs, and base64 dumps included - dated so that it's the
+    newest message in the folder.
+    """
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.2:
+            line = "https://example.com/" + "a" * rng.randint(50, 500)
+        elif kind < 0.4:
+            line = "QUJD" * rng.randint(10, 300)
+        else:
+            line = _words(rng, rng.randint(3, 60))
+        lines.append(line)
+        length += len(line) + 1
+    mailfile = Path(folder, "9999999999.log.bench.eml")
+    mailfile.write_text(
+        "Date: Fri, 31 Dec 2100 23:59:59 +0000\n"
+        "From: Logger <logs@example.com>\n"
+        "Subject: Nightly log\n"
+        "MIME-Version: 1.0\n"
+        'Content-Type: text/plain; charset="utf-8"\n'
+        "Content-Transfer-Encoding: 8bit\n\n" + "\n".join(lines) + "\n"
+    )
+    return mailfile
+
+
+def generate_maildir(maildir, *, count, seed=42):
+    maildir = Path(maildir)
+    wemail.ensure_maildirs_exist(maildir=maildir)
+    generate_messages(maildir / "cur", count=count, seed=seed)
+    return maildir
+
+
+def _bench_config(maildir, *, smtp_port=None):
+    return {
+        "maildir": maildir,
+        "curdir": maildir / "cur",
+        "EDITOR": "true",
+        "default_part": 1,
+        "SMTP_HOST": "localhost",
+        "SMTP_PORT": smtp_port,
+    }
+
+
+def peak_rss_kb():
+    """
+    Return the peak RSS of this process in KB. On Linux that's
+    ``VmHWM`` from ``/proc/self/status``, which starts over at exec.
+    ``ru_maxrss`` doesn't - a forked child keeps the parent's high water
+    mark, so a big parent would hide the child's real peak. Elsewhere
+    ``ru_maxrss`` is all we've got.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        maxrss //= 1024
+    return maxrss
+
+
+def measure(command, maildir, *, smtp_port=None):
+    """
+    Run ``command`` against ``maildir`` in this process, and return the
+    wall time and peak RSS.
+    """
+    maildir = Path(maildir)
+    config = _bench_config(maildir, smtp_port=smtp_port)
+    count = sum(1 for _ in wemail.scan_maildir(config["curdir"]))
+    out = io.StringIO()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(out), mock.patch(
+        "builtins.input", return_value="y"
+    ):
+        if command == "baseline":
+            pass
+        elif command in ("list", "list-cold"):
+            wemail.list_messages(config=config)
+        elif command == "read":
+            wemail.read(config=config, mailnumber=max(count // 2, 1))
+        elif command == "read-wrap":
+            wemail.read(config=config, mailnumber=count, wrap=True)
+        elif command == "check":
+            wemail.check_email(config=config)
+        elif command == "save":
+            wemail.save(
+                config=config,
+                maildir=config["curdir"],
+                mailnumber=1,
+                target_folder="saved-messages",
+            )
+        elif command == "remove":
+            wemail.remove(config=config, maildir=config["curdir"], mailnumber=1)
+        elif command == "send_all":
+            wemail.send_all(config=config)
+        else:
+            raise ValueError(f"Unknown command {command!r}")
+    wall = time.perf_counter() - start
+    return {"wall": wall, "maxrss_kb": peak_rss_kb()}
+
+
+def _count_syscalls(strace_output):
+    """
+    Return the total number of calls from ``strace -c`` output, which
+    ends with a line like ``100.00  0.001  2  306  24 total``.
+    """
+    for line in reversed(strace_output.splitlines()):
+        match = re.match(r"\s*100\.00\s+[\d.]+\s+\d+\s+(\d+)\s", line)
+        if match and line.rstrip().endswith("total"):
+            return int(match[1])
+    return None
+
+
+def run_one(command, maildir, *, smtp_port=None, syscalls=True):
+    """
+    Measure ``command`` in a fresh Python process, under ``strace`` if
+    it's available and ``syscalls`` is set.
+    """
+    argv = [sys.executable, __file__, "_measure", command, str(maildir)]
+    if smtp_port is not None:
+        argv += ["--smtp-port", str(smtp_port)]
+    strace = shutil.which("strace") if syscalls else None
+    with tempfile.NamedTemporaryFile("r", suffix=".strace") as trace:
+        if strace:
+            argv = [strace, "-f", "-c", "-o", trace.name] + argv
+        ret = subprocess.run(argv, capture_output=True, text=True)
+        if ret.returncode:
+            raise RuntimeError(f"{command} failed:\n{ret.stderr}")
+        result = json.loads(ret.stdout.strip().splitlines()[-1])
+        result["syscalls"] = _count_syscalls(trace.read()) if strace else None
+    return result
+
+
+@contextlib.contextmanager
+def smtp_sink():
+    """
+    Run a local aiosmtpd server that accepts, and throws away, everything.
+    """
+    from aiosmtpd.controller import Controller
+
+    class Sink:
+        async def handle_DATA(self, server, session, envelope):
+            return "250 OK"
+
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    controller = Controller(Sink(), hostname="localhost", port=port)
+    controller.start()
+    try:
+        yield port
+    finally:
+        controller.stop()
+
+
+def run_suite(*, sizes, commands, workdir=None, syscalls=True):
+    results = []
+    with tempfile.TemporaryDirectory(dir=workdir) as dirname, smtp_sink() as port:
+        for size in sizes:
+            maildir = Path(dirname, f"maildir-{size}")
+            print(f"Generating {size} messages in {maildir}...", file=sys.stderr)
+            generate_maildir(maildir, count=size)
+            for command in commands:
+                if command == "read-wrap":
+                    generate_log_message(maildir / "cur")
+                elif command == "check":
+                    generate_messages(maildir / "new", count=NEW_COUNT, prefix="new")
+                elif command == "send_all":
+                    generate_messages(
+                        maildir / "outbox", count=OUTBOX_COUNT, prefix="out"
+                    )
+                result = run_one(command, maildir, smtp_port=port, syscalls=syscalls)
+                results.append(dict(result, size=size, command=command))
+                print_result(results[-1])
+            shutil.rmtree(maildir)
+    return results
+
+
+def print_result(result):
+    syscalls = result["syscalls"]
+    print(
+        f"{result['size']:>9} {result['command']:<10}"
+        f" {result['wall']:>9.3f}s {result['maxrss_kb'] / 1024:>9.1f}MB"
+        f" {syscalls if syscalls is not None else 'n/a':>10}"
+    )
+    sys.stdout.flush()
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers()
+
+    generate_parser = subparsers.add_parser(
+        "generate", help="Generate a synthetic maildir."
+    )
+    generate_parser.set_defaults(action="generate")
+    generate_parser.add_argument("maildir", type=Path)
+    generate_parser.add_argument("--count", type=int, default=DEFAULT_SIZES[0])
+    generate_parser.add_argument("--seed", type=int, default=42)
+
+    run_parser = subparsers.add_parser("run", help="Run the benchmark suite.")
+    run_parser.set_defaults(action="run")
+    run_parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=list(DEFAULT_SIZES),
+        help="Maildir sizes to benchmark, e.g. 1000 10000 100000 1000000",
+    )
+    run_parser.add_argument(
+        "--commands", nargs="+", choices=COMMANDS, default=list(COMMANDS)
+    )
+    run_parser.add_argument(
+        "--workdir", type=Path, help="Where to generate the maildirs."
+    )
+    run_parser.add_argument(
+        "--json", type=Path, help="Also write the results to this file."
+    )
+    run_parser.add_argument(
+        "--no-syscalls",
+        action="store_true",
+        help="Don't count syscalls, even if strace is available.",
+    )
+
+    measure_parser = subparsers.add_parser("_measure")
+    measure_parser.set_defaults(action="_measure")
+    measure_parser.add_argument("command", choices=COMMANDS)
+    measure_parser.add_argument("maildir", type=Path)
+    measure_parser.add_argument("--smtp-port", type=int)
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if "action" not in args:
+        parser.exit(message=parser.format_help())
+    if args.action == "generate":
+        generate_maildir(args.maildir, count=args.count, seed=args.seed)
+    elif args.action == "_measure":
+        print(json.dumps(measure(args.command, args.maildir, smtp_port=args.smtp_port)))
+    elif args.action == "run":
+        print(
+            f"{'messages':>9} {'command':<10} {'wall':>10}"
+            f" {'peak RSS':>11} {'syscalls':>10}"
+        )
+        results = run_suite(
+            sizes=args.sizes,
+            commands=args.commands,
+            workdir=args.workdir,
+            syscalls=not args.no_syscalls,
+        )
+        if args.json:
+            args.json.write_text(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
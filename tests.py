@@ -1,12 +1,18 @@
 import io
+import asyncio
 import datetime
 import json
+import os
 import pathlib
 import ssl
 import pkg_resources
 import smtplib
+import socket
 import tempfile
 import textwrap
+import threading
+import time
+import zipfile
 
 import pytest
 import mistletoe
@@ -343,7 +349,10 @@ def test_when_action_is_send_it_should_send(args_send, good_loaded_config):
     with patch_send as fake_send, patch_config:
         wemail.do_it_two_it(args_send)
         fake_send.assert_called_with(
-            config=good_loaded_config, mailfile=args_send.mailfile
+            config=good_loaded_config,
+            mailfile=args_send.mailfile,
+            use_async=False,
+            timings=None,
         )
 
 
@@ -352,7 +361,9 @@ def test_when_action_is_send_all_it_should_send_all(args_send_all, good_loaded_c
     patch_config = mock.patch("wemail.load_config", return_value=good_loaded_config)
     with patch_send_all as fake_send_all, patch_config:
         wemail.do_it_two_it(args_send_all)
-        fake_send_all.assert_called_with(config=good_loaded_config)
+        fake_send_all.assert_called_with(
+            config=good_loaded_config, jobs=1, use_async=False, timings=None
+        )
 
 
 def test_when_action_is_check_it_should_check(args_check, good_loaded_config):
@@ -423,7 +434,16 @@ def test_when_action_is_list_it_should_list(args_list, good_loaded_config):
     patch_list = mock.patch("wemail.list_messages", autospec=True)
     with patch_list as fake_list, patch_config:
         wemail.do_it_two_it(args_list)
-        fake_list.assert_called_with(config=good_loaded_config)
+        fake_list.assert_called_with(
+            config=good_loaded_config,
+            show_ids=False,
+            limit=None,
+            offset=0,
+            since=None,
+            until=None,
+            with_attachments=False,
+            jobs=1,
+        )
 
 
 def test_when_action_is_raw_it_should_raw(args_raw, good_loaded_config):
@@ -712,6 +732,145 @@ def test_files_should_be_sorted_in_date_header_order():
         assert actual_order == expected_order
 
 
+def test_sorted_mailfiles_should_only_reparse_new_or_changed_files():
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        for i in range(3):
+            (maildir / f"file_{i}.eml").write_text(f"Subject: {i}\n\nHi")
+        wemail.sorted_mailfiles(maildir=maildir)
+        (maildir / "file_1.eml").write_text("Subject: changed\n\nHello there")
+
+        with mock.patch(
+            "wemail.parse_headers", wraps=wemail.parse_headers
+        ) as fake_parse:
+            wemail.sorted_mailfiles(maildir=maildir)
+
+        assert fake_parse.call_count == 1
+
+
+def test_sorted_mailfiles_should_not_include_the_index():
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        (maildir / "file.eml").write_text("Subject: Only\n\n")
+
+        wemail.sorted_mailfiles(maildir=maildir)
+        actual = wemail.sorted_mailfiles(maildir=maildir)
+
+        assert (maildir / wemail.INDEX_FILENAME).exists()
+        assert actual == [maildir / "file.eml"]
+
+
+def test_index_page_should_carry_indexed_headers():
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        (maildir / "file.eml").write_text(
+            "Date: Sun, 26 Aug 1984 13:32:02 +0100\nFrom: me@example.com\n"
+            "Subject: Hi\nMessage-ID: <1@example.com>\n\nBody"
+        )
+
+        with wemail.MailIndex(maildir=maildir) as index:
+            index.refresh()
+            ((number, record),) = index.page()
+
+        assert number == 1
+        assert record.sender == "me@example.com"
+        assert record.subject == "Hi"
+        assert record.message_id == "<1@example.com>"
+        assert record.date == "Sun, 26 Aug 1984 13:32:02 +0100"
+
+
+def test_headers_should_be_parsed_once_per_file():
+    wemail._cached_headers.cache_clear()
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        for i in range(3):
+            (maildir / f"file_{i}.eml").write_text(f"Subject: {i}\n\nHi")
+
+        with mock.patch(
+            "wemail.parse_headers", wraps=wemail.parse_headers
+        ) as fake_parse:
+            subjects = [h["subject"] for h in wemail.iter_headers(maildir=maildir)]
+            for file in maildir.glob("*.eml"):
+                wemail.get_msg_date(file)
+
+        assert sorted(subjects) == ["0", "1", "2"]
+        assert fake_parse.call_count == 3
+
+
+def test_parse_headers_should_stop_reading_at_the_end_of_the_headers():
+    body = b"x" * (wemail.HEADER_CHUNK_SIZE * 10)
+    f = io.BytesIO(
+        b"From: me@example.com\r\n"
+        b"Subject: =?iso-8859-1?q?p=F6stal?=\r\n"
+        b" is folded\r\n"
+        b"\r\n" + body
+    )
+
+    headers = wemail.parse_headers(f)
+
+    assert headers["subject"] == "p\xf6stal is folded"
+    assert headers["from"] == "me@example.com"
+    assert f.tell() <= wemail.HEADER_CHUNK_SIZE
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 5, 4096])
+def test_read_header_bytes_should_find_the_blank_line_across_chunks(chunk_size):
+    raw = b"Subject: hi\nTo: you\n\nbody\n\nmore body"
+
+    actual = wemail.read_header_bytes(io.BytesIO(raw), chunk_size=chunk_size)
+
+    assert actual == b"Subject: hi\nTo: you\n\n"
+
+
+def test_refresh_should_reuse_the_directory_entry_stat():
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        for i in range(3):
+            (maildir / f"file_{i}.eml").write_text(f"Subject: {i}\n\nHi")
+        no_stat = mock.patch("wemail.os.stat", side_effect=AssertionError)
+        no_path_stat = mock.patch("pathlib.Path.stat", side_effect=AssertionError)
+
+        with no_stat, no_path_stat, wemail.MailIndex(maildir=maildir) as index:
+            index.refresh()
+            records = [record for _, record in index.page()]
+
+        assert sorted(r.subject for r in records) == ["0", "1", "2"]
+
+
+def test_opening_an_up_to_date_index_should_not_write_to_it():
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        with wemail.MailIndex(maildir=maildir):
+            pass
+        expected = (maildir / wemail.INDEX_FILENAME).read_bytes()
+
+        with wemail.MailIndex(maildir=maildir):
+            pass
+
+        assert (maildir / wemail.INDEX_FILENAME).read_bytes() == expected
+
+
+def test_parallel_refresh_should_index_the_same_as_serial_refresh():
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        for i in range(9):
+            (maildir / f"file_{i}.eml").write_text(
+                f"Date: Sat, {9 - i:02} Aug 2020 12:00:00 +0000\nSubject: {i}\n\n"
+            )
+        with wemail.MailIndex(maildir=maildir) as index:
+            index.refresh()
+            expected = [record for _, record in index.page()]
+        (maildir / wemail.INDEX_FILENAME).unlink()
+
+        with mock.patch("wemail.INDEX_CHUNK_SIZE", 2), wemail.MailIndex(
+            maildir=maildir
+        ) as index:
+            index.refresh(jobs=3)
+            actual = [record for _, record in index.page()]
+
+        assert actual == expected
+
+
 #####################
 # End maildir tests }}}
 #####################
@@ -772,6 +931,7 @@ def test_when_check_email_is_called_it_should_move_all_files_from_new_to_cur(
 
 
 def test_simple_single_mail_should_fire_external_viewer_with_email(good_loaded_config):
+    good_loaded_config["curdir"] = good_loaded_config["maildir"] / "cur"
     wemail.check_email(good_loaded_config)
     msg = next(wemail.iter_messages(maildir=good_loaded_config["maildir"] / "cur"))
     with mock.patch("subprocess.run", autospec=True) as fake_run:
@@ -814,6 +974,216 @@ def test_read_single_email_with_wrap_arg_should_wrap_the_email(
     assert actual_lines[-3:] == lines
 
 
+def test_read_should_only_parse_the_requested_message(good_loaded_config):
+    wemail.check_email(good_loaded_config)
+    good_loaded_config["curdir"] = good_loaded_config["maildir"] / "cur"
+    expected_file = wemail.sorted_mailfiles(maildir=good_loaded_config["curdir"])[2]
+    actual_text = None
+
+    def fake_editor(*args, **kwargs):
+        nonlocal actual_text
+        with open(args[0][1]) as f:
+            actual_text = f.read()
+
+    with mock.patch(
+        "subprocess.run", autospec=True, side_effect=fake_editor
+    ), mock.patch("wemail.map_mailfile", wraps=wemail.map_mailfile) as fake_map:
+        wemail.read(config=good_loaded_config, mailnumber=3)
+
+    fake_map.assert_called_once_with(expected_file)
+    assert actual_text.endswith("Let's have a fight!")
+
+
+@pytest.fixture()
+def multipart_email():
+    msg = wemail.EmailMessage(policy=wemail.POLICY)
+    msg["From"] = "me@example.com"
+    msg["Subject"] = "Parts"
+    msg.set_content("plain text \N{SNAKE}\n" * 10, cte="quoted-printable")
+    msg.add_alternative("<p>html</p>", subtype="html")
+    msg.add_attachment(
+        bytes(range(256)) * 100,
+        maintype="application",
+        subtype="octet-stream",
+        filename="blob.bin",
+    )
+    return msg
+
+
+def test_mime_tree_should_match_the_email_parser(multipart_email):
+    data = multipart_email.as_bytes()
+    expected = list(wemail._parser.parsebytes(data).walk())
+
+    tree = list(wemail.mime_tree(data))
+
+    assert [p.content_type for p in tree] == [p.get_content_type() for p in expected]
+    assert [p.filename for p in tree] == [p.get_filename() for p in expected]
+    assert [p.depth for p in tree] == [0, 1, 2, 2, 1]
+    for part, msgpart in zip(tree, expected):
+        if not msgpart.is_multipart():
+            actual = b"".join(wemail.iter_decoded(data, part))
+            assert actual == msgpart.get_payload(decode=True)
+
+
+@pytest.mark.parametrize(
+    "content_type, disposition",
+    [
+        (None, None),
+        ("Text/Plain; charset=UTF-8", "inline"),
+        ('text/plain; name="=?utf-8?q?caf=C3=A9.txt?="', None),
+        ("garbage", "attachment; filename*=utf-8''caf%C3%A9.txt"),
+        ('multipart/mixed; boundary="a b "', None),
+    ],
+)
+def test_content_info_should_match_the_message_methods(content_type, disposition):
+    raw = b"From: me@example.com\n"
+    if content_type:
+        raw += f"Content-Type: {content_type}\n".encode()
+    if disposition:
+        raw += f"Content-Disposition: {disposition}\n".encode()
+    headers = wemail._header_parser.parsebytes(raw + b"\n")
+    headers.set_default_type("message/rfc822")
+
+    actual = wemail.content_info(headers, default_type="message/rfc822")
+
+    assert actual == (
+        headers.get_content_type(),
+        headers.get_filename(),
+        headers.get_content_charset(),
+        headers.get_boundary(),
+    )
+
+
+@pytest.mark.parametrize("cte", ["base64", "quoted-printable", "8bit"])
+def test_summarize_parts_with_headers_should_match_the_mime_tree(cte):
+    msg = wemail.EmailMessage(policy=wemail.POLICY)
+    msg["Subject"] = "Just text"
+    msg.set_content("Hello there\n" * 100, cte=cte)
+    with tempfile.TemporaryDirectory() as dirname:
+        file = pathlib.Path(dirname) / "file.eml"
+        file.write_bytes(msg.as_bytes())
+
+        with mock.patch("wemail.mime_tree", wraps=wemail.mime_tree) as fake_tree:
+            actual = wemail.summarize_parts(file, headers=wemail.get_headers(file))
+
+        assert actual == wemail.summarize_parts(file)
+        fake_tree.assert_not_called()
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 5, 76, 77, 4096])
+@pytest.mark.parametrize("cte", ["base64", "quoted-printable", "8bit"])
+def test_iter_decoded_should_match_the_email_parser_for_any_chunk_size(chunk_size, cte):
+    msg = wemail.EmailMessage(policy=wemail.POLICY)
+    msg.set_content(
+        "caf\N{LATIN SMALL LETTER E WITH ACUTE} = \N{SNAKE}\t\n" * 30
+        + "x" * 200
+        + " \n",
+        cte=cte,
+    )
+    data = msg.as_bytes()
+    (part,) = wemail.mime_tree(data)
+
+    actual = b"".join(wemail.iter_decoded(data, part, chunk_size=chunk_size))
+
+    assert actual == msg.get_payload(decode=True)
+
+
+def test_read_should_only_decode_the_selected_part(multipart_email, good_loaded_config):
+    curdir = good_loaded_config["maildir"] / "cur"
+    (curdir / "parts.eml").write_bytes(multipart_email.as_bytes())
+    good_loaded_config["curdir"] = curdir
+    actual_text = None
+
+    def fake_editor(*args, **kwargs):
+        nonlocal actual_text
+        with open(args[0][1], "rb") as f:
+            actual_text = f.read().decode()
+
+    with mock.patch(
+        "subprocess.run", autospec=True, side_effect=fake_editor
+    ), mock.patch("wemail.iter_decoded", wraps=wemail.iter_decoded) as fake_decode:
+        wemail.read(config=good_loaded_config, mailnumber=1, part=2)
+
+    fake_decode.assert_called_once()
+    assert fake_decode.call_args[0][1].content_type == "text/html"
+    assert actual_text == "From: me@example.com\nSubject: Parts\n\n\n<p>html</p>\n"
+
+
+def test_read_again_should_use_the_cached_view(multipart_email, good_loaded_config):
+    curdir = good_loaded_config["maildir"] / "cur"
+    (curdir / "parts.eml").write_bytes(multipart_email.as_bytes())
+    good_loaded_config["curdir"] = curdir
+    views = []
+
+    def fake_editor(*args, **kwargs):
+        with open(args[0][1], "rb") as f:
+            views.append(f.read())
+
+    with mock.patch("subprocess.run", autospec=True, side_effect=fake_editor):
+        wemail.read(config=good_loaded_config, mailnumber=1, part=1, wrap=True)
+        with mock.patch("wemail.iter_decoded") as fake_decode:
+            wemail.read(config=good_loaded_config, mailnumber=1, part=1, wrap=True)
+            wemail.read(config=good_loaded_config, mailnumber=1, part=2, wrap=True)
+
+    assert fake_decode.call_count == 1
+    assert views[0] == views[1]
+    assert views[0].endswith("plain text \N{SNAKE}\n".encode())
+
+
+def test_read_with_no_view_cache_size_should_not_cache(
+    multipart_email, good_loaded_config
+):
+    curdir = good_loaded_config["maildir"] / "cur"
+    (curdir / "parts.eml").write_bytes(multipart_email.as_bytes())
+    good_loaded_config["curdir"] = curdir
+    good_loaded_config["view_cache_size"] = 0
+
+    with mock.patch("subprocess.run", autospec=True):
+        wemail.read(config=good_loaded_config, mailnumber=1, part=1)
+
+    assert not (good_loaded_config["maildir"] / ".view-cache").exists()
+
+
+def test_prune_view_cache_should_remove_least_recently_used_views(tmp_path):
+    for i, name in enumerate(["old", "newest", "middle"]):
+        view = tmp_path / f"{name}.eml"
+        view.write_bytes(b"x" * 10)
+        os.utime(view, ns=(0, [1, 3, 2][i] * 10**9))
+
+    wemail.prune_view_cache(tmp_path, max_size=25)
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["middle.eml", "newest.eml"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 80, 10000])
+def test_iter_wrapped_should_not_care_how_the_text_is_chunked(chunk_size):
+    text = (
+        "short\n"
+        + " ".join(["word"] * 50)
+        + "\r\n"
+        + "https://example.com/"
+        + "x" * 200
+        + " tail\n\n  indented   spaces\nno newline at the end"
+    )
+    chunks = [text[i : i + chunk_size] for i in range(0, len(text), chunk_size)]
+    expected = [
+        "short\n",
+        " ".join(["word"] * 16) + "\n",
+        " ".join(["word"] * 16) + "\n",
+        " ".join(["word"] * 16) + "\n",
+        "word word\r\n",
+        "https://example.com/" + "x" * 200 + "\n",
+        "tail\n",
+        "\n",
+        "  indented   spaces\n",
+        "no newline at the end",
+    ]
+
+    actual = list(wemail.iter_wrapped(chunks, width=80))
+
+    assert actual == expected
+
+
 def test_list_should_list_the_messages(capsys, good_loaded_config):
     expected_message = (
         " 1. 2010-08-14 13:32 - person.man@example.com - I hate you\n"
@@ -831,6 +1201,132 @@ def test_list_should_list_the_messages(capsys, good_loaded_config):
     assert captured.out == expected_message
 
 
+@pytest.fixture()
+def dated_curdir_config(good_loaded_config):
+    curdir = good_loaded_config["maildir"] / "cur"
+    for day in range(1, 11):
+        (curdir / f"day{day}.eml").write_text(
+            f"Date: Sat, {day:02} Aug 2020 12:00:00 +0000\n"
+            f"From: me@example.com\nSubject: Day {day}\n\nHi"
+        )
+    good_loaded_config["curdir"] = curdir
+    return good_loaded_config
+
+
+@pytest.mark.parametrize(
+    "kwargs,expected_days",
+    [
+        ({"limit": 3}, [8, 9, 10]),
+        ({"limit": 2, "offset": 3}, [6, 7]),
+        (
+            {"since": datetime.datetime(2020, 8, 8, tzinfo=datetime.timezone.utc)},
+            [8, 9, 10],
+        ),
+        (
+            {"until": datetime.datetime(2020, 8, 3, tzinfo=datetime.timezone.utc)},
+            [1, 2],
+        ),
+        (
+            {
+                "since": datetime.datetime(2020, 8, 2, tzinfo=datetime.timezone.utc),
+                "until": datetime.datetime(2020, 8, 9, tzinfo=datetime.timezone.utc),
+                "limit": 2,
+                "offset": 1,
+            },
+            [6, 7],
+        ),
+    ],
+)
+def test_list_with_paging_should_keep_the_message_numbers(
+    capsys, dated_curdir_config, kwargs, expected_days
+):
+    wemail.list_messages(config=dated_curdir_config, **kwargs)
+    lines = capsys.readouterr().out.splitlines()
+
+    assert [line.split(".")[0].strip() for line in lines] == [
+        str(day) for day in expected_days
+    ]
+    assert [line.rpartition(" ")[-1] for line in lines] == [
+        str(day) for day in expected_days
+    ]
+
+
+def test_list_since_should_accept_dates_from_the_command_line():
+    args = parser.parse_args(["list", "--since", "2020-08-14", "--limit", "20"])
+
+    assert args.since == datetime.datetime(2020, 8, 14, tzinfo=wemail.LOCAL_TZ)
+    assert args.limit == 20
+
+
+def test_list_with_show_ids_should_list_stable_ids(capsys, good_loaded_config):
+    wemail.check_email(good_loaded_config)
+    capsys.readouterr()
+    good_loaded_config["curdir"] = good_loaded_config["maildir"] / "cur"
+    expected_id = wemail.make_short_id("message3.eml")
+
+    wemail.list_messages(config=good_loaded_config, show_ids=True)
+    captured = capsys.readouterr()
+
+    assert captured.out.splitlines()[0] == (
+        f" 1. {expected_id} 2010-08-14 13:32 - person.man@example.com - I hate you"
+    )
+
+
+def test_short_ids_should_never_look_like_message_numbers():
+    for key in ("1", "<1234@example.com>", "message3.eml", ""):
+        short_id = wemail.make_short_id(key)
+
+        assert wemail.is_short_id(short_id)
+        assert not short_id.isdigit()
+
+
+def test_resolve_mailfile_by_id_should_not_sort_the_folder(good_loaded_config):
+    maildir = good_loaded_config["maildir"] / "cur"
+    mailfile = maildir / "fnord.eml"
+    mailfile.write_text("Message-ID: <fnord@example.com>\nSubject: hi\n\nhi")
+    wemail.sorted_mailfiles(maildir=maildir)
+    short_id = wemail.make_short_id("<fnord@example.com>")
+
+    with mock.patch("wemail.MailIndex.names", autospec=True) as fake_names:
+        actual = wemail.resolve_mailfile(maildir=maildir, mailnumber=short_id)
+
+    fake_names.assert_not_called()
+    assert actual == mailfile
+
+
+def test_resolve_mailfile_with_unknown_id_should_raise_index_error(
+    good_loaded_config,
+):
+    with pytest.raises(IndexError):
+        wemail.resolve_mailfile(
+            maildir=good_loaded_config["maildir"] / "cur", mailnumber="abcdefghij"
+        )
+
+
+def test_resolve_mailfile_with_neither_number_nor_id_should_raise_wemail_error(
+    good_loaded_config,
+):
+    with pytest.raises(wemail.WEmailError):
+        wemail.resolve_mailfile(
+            maildir=good_loaded_config["maildir"] / "cur", mailnumber="fnord"
+        )
+
+
+@pytest.mark.parametrize("action", ["read", "raw", "parts", "save", "rm", "attachment"])
+def test_mailnumber_that_is_neither_number_nor_id_should_be_a_usage_error(
+    action, capsys
+):
+    with pytest.raises(SystemExit):
+        wemail.make_parser().parse_args([action, "fnord"])
+
+    assert "invalid message number or id: 'fnord'" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("value, expected", [("3", 3), ("abcdefghij", "abcdefghij")])
+def test_mailnumber_arg_should_take_a_number_or_an_id(value, expected):
+    assert wemail.make_parser().parse_args(["read", value]).mailnumber == expected
+
+
 # End read email tests }}}
 
 # {{{ Send email tests
@@ -891,7 +1387,7 @@ def test_send_email_with_use_ssl_should_send_provided_email(
 def test_send_should_display_sending_status(capsys, sample_good_mailfile):
     expected_message = 'Sending "why don\'t you like me?" to Triangle Man <triangle@example.com> ... OK\n'
 
-    with mock.patch("wemail.send_message", autospec=True):
+    with mock.patch("wemail.send_raw", autospec=True):
         wemail.send(
             config={"maildir": sample_good_mailfile.parent.parent},
             mailfile=sample_good_mailfile,
@@ -927,31 +1423,720 @@ def test_send_should_override_defaults_with_account_settings_from_config(
             "SMTP_PASSWORD": expected_password,
         },
     }
-    email = wemail._parser.parsebytes(sample_good_mailfile.read_bytes())
-    mock_parser = mock.patch(
-        "wemail._parser.parsebytes", mock.MagicMock(return_value=email)
-    )
-    with mock.patch(
-        "wemail.send_message", autospec=True
-    ) as fake_send_message, mock_parser:
+    with mock.patch("wemail.send_raw", autospec=True) as fake_send_raw:
         wemail.send(config=config, mailfile=sample_good_mailfile)
 
-        fake_send_message.assert_called_with(
-            msg=email,
+        fake_send_raw.assert_called_with(
+            mailfile=sample_good_mailfile,
+            headers=mock.ANY,
             smtp_host=expected_host,
             smtp_port=expected_port,
             use_tls=expected_use_tls,
             use_smtps=expected_use_smtps,
             username=expected_username,
             password=expected_password,
+            pool=mock.ANY,
+            timings=None,
+        )
+
+
+def test_send_should_parse_the_draft_once_and_time_each_stage(
+    outbox_config, test_server
+):
+    with tempfile.TemporaryDirectory() as td:
+        attachment = pathlib.Path(td, "notes.txt")
+        attachment.write_text("some notes\n")
+        mailfile = outbox_config["maildir"] / "outbox" / "pipeline.eml"
+        draft = wemail.EmailMessage()
+        draft["From"] = "me@example.com"
+        draft["To"] = "you@example.com"
+        draft["Subject"] = "Pipeline"
+        draft["X-CommonMark"] = "True"
+        draft["Attachment"] = str(attachment)
+        draft.set_content("*bold* text")
+        mailfile.write_bytes(draft.as_bytes())
+        timings = wemail.StageTimings()
+
+        with mock.patch(
+            "wemail._parser.parsebytes", wraps=wemail._parser.parsebytes
+        ) as fake_parse:
+            wemail.send(
+                config=outbox_config,
+                mailfile=mailfile,
+                interactive=False,
+                timings=timings,
+            )
+
+    assert fake_parse.call_count == 1
+    assert list(timings.stages) == [
+        "headers",
+        "parse",
+        "markdown",
+        "date",
+        "attachments",
+        "generate",
+        "deliver",
+    ]
+    (envelope,) = test_server.handler.box
+    msg = wemail._parser.parsebytes(envelope.content)
+    assert "<em>bold</em>" in msg.get_body(("html",)).get_content()
+    assert next(msg.iter_attachments()).get_content() == "some notes\n"
+    assert msg["Date"]
+
+
+def test_send_without_transforms_should_send_the_file_as_is(outbox_config, test_server):
+    mailfile = outbox_config["maildir"] / "outbox" / "raw.eml"
+    mailfile.write_bytes(
+        b"From: me@example.com\nTo: you@example.com, them@example.com\n"
+        b"Subject: Raw\n\n.leading dot\n..two dots\nno newline"
+    )
+
+    with mock.patch("wemail._parser.parsebytes") as fake_parse:
+        wemail.send(config=outbox_config, mailfile=mailfile, interactive=False)
+
+    fake_parse.assert_not_called()
+    (envelope,) = test_server.handler.box
+    assert envelope.rcpt_tos == ["you@example.com", "them@example.com"]
+    date, _, content = envelope.content.partition(b"\r\n")
+    assert date.startswith(b"Date: ")
+    assert content == (
+        b"From: me@example.com\r\nTo: you@example.com, them@example.com\r\n"
+        b"Subject: Raw\r\n\r\n.leading dot\r\n..two dots\r\nno newline\r\n"
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 100])
+def test_iter_data_should_quote_lines_split_across_chunks(chunk_size):
+    data = b".one\r\ntwo\r.three\n\n..four"
+    chunks = [data[i : i + chunk_size] for i in range(0, len(data), chunk_size)]
+
+    actual = b"".join(wemail.iter_data(chunks))
+
+    assert actual == b"..one\r\ntwo\r\n..three\r\n\r\n...four\r\n"
+
+
+@pytest.mark.parametrize("header", wemail.OUTGOING_TRANSFORM_HEADERS)
+def test_drafts_with_transform_headers_should_not_be_sent_raw(header):
+    headers = wemail.EmailMessage()
+    headers["To"] = "you@example.com"
+    headers[header] = "x"
+
+    assert wemail.can_send_raw(headers) is False
+
+
+def make_test_messages(count):
+    for i in range(count):
+        msg = wemail.EmailMessage()
+        msg["From"] = f"me{i}@example.com"
+        msg["To"] = "you@example.com"
+        msg.set_content(f"Message {i}")
+        yield msg
+
+
+def test_smtp_pool_should_reuse_one_connection_for_many_messages(test_server):
+    settings = {"smtp_host": test_server.hostname, "smtp_port": test_server.port}
+
+    with mock.patch(
+        "wemail.smtplib.SMTP", wraps=smtplib.SMTP
+    ) as fake_smtp, wemail.SMTPPool() as pool:
+        for msg in make_test_messages(3):
+            wemail.send_message(msg=msg, pool=pool, **settings)
+
+    assert fake_smtp.call_count == 1
+    assert [e.mail_from for e in test_server.handler.box] == [
+        "me0@example.com",
+        "me1@example.com",
+        "me2@example.com",
+    ]
+
+
+def test_smtp_pool_should_reconnect_when_the_connection_drops(test_server):
+    settings = {"smtp_host": test_server.hostname, "smtp_port": test_server.port}
+    first, second = make_test_messages(2)
+
+    with mock.patch(
+        "wemail.smtplib.SMTP", wraps=smtplib.SMTP
+    ) as fake_smtp, wemail.SMTPPool() as pool:
+        wemail.send_message(msg=first, pool=pool, **settings)
+        with pool.connection(**settings) as smtp:
+            smtp.sock.shutdown(socket.SHUT_RDWR)
+        wemail.send_message(msg=second, pool=pool, **settings)
+
+    assert fake_smtp.call_count == 2
+    assert len(test_server.handler.box) == 2
+
+
+class RejectingHandler(MyHandler):
+    async def handle_DATA(self, server, session, envelope):
+        self.box.append(envelope)
+        return "554 5.6.0 Message rejected"
+
+
+@pytest.fixture()
+def rejecting_test_server():
+    handler = RejectingHandler()
+    controller = Controller(handler, port=8177)
+    controller.handler = handler
+    controller.start()
+    try:
+        yield controller
+    finally:
+        controller.stop()
+
+
+def test_smtp_pool_should_not_retry_a_refusal_or_drop_the_connection(
+    rejecting_test_server,
+):
+    settings = {
+        "smtp_host": rejecting_test_server.hostname,
+        "smtp_port": rejecting_test_server.port,
+    }
+    envelope = wemail.make_envelope(next(make_test_messages(1)))
+
+    with wemail.SMTPPool() as pool:
+        with pytest.raises(smtplib.SMTPDataError):
+            pool.sendmail(envelope, **settings)
+
+        assert len(rejecting_test_server.handler.box) == 1
+        assert sum(len(idle) for idle in pool._idle.values()) == 1
+
+
+def test_async_pool_should_not_retry_a_refusal_or_drop_the_connection(
+    rejecting_test_server,
+):
+    settings = {
+        "smtp_host": rejecting_test_server.hostname,
+        "smtp_port": rejecting_test_server.port,
+    }
+    envelope = wemail.make_envelope(next(make_test_messages(1)))
+
+    async def send():
+        async with wemail.AsyncSMTPPool() as pool:
+            with pytest.raises(smtplib.SMTPDataError):
+                await pool.sendmail(envelope, **settings)
+            return sum(len(idle) for idle in pool._idle.values())
+
+    assert asyncio.run(send()) == 1
+    assert len(rejecting_test_server.handler.box) == 1
+
+
+@pytest.fixture()
+def outbox_config(test_server):
+    with tempfile.TemporaryDirectory() as dirname:
+        maildir = pathlib.Path(dirname)
+        wemail.ensure_maildirs_exist(maildir=maildir)
+        for i, msg in enumerate(make_test_messages(6)):
+            msg["Subject"] = "Same subject"
+            (maildir / "outbox" / f"{i}.eml").write_bytes(msg.as_bytes())
+        yield {
+            "maildir": maildir,
+            "SMTP_HOST": test_server.hostname,
+            "SMTP_PORT": test_server.port,
+        }
+
+
+def test_send_all_with_jobs_should_send_everything_and_keep_every_sent_file(
+    outbox_config, test_server, capsys
+):
+    with mock.patch("builtins.input", return_value="y"):
+        wemail.send_all(config=outbox_config, jobs=3)
+
+    assert len(test_server.handler.box) == 6
+    assert not list((outbox_config["maildir"] / "outbox").iterdir())
+    assert len(list((outbox_config["maildir"] / "sent").iterdir())) == 6
+    assert capsys.readouterr().out.count("OK     ") == 6
+
+
+def test_send_all_should_respect_the_host_limit_and_report_failures(
+    outbox_config, capsys
+):
+    outbox_config["SMTP_MAX_CONNECTIONS"] = 1
+    lock = threading.Lock()
+    in_flight = []
+    most_in_flight = 0
+
+    def fake_send(*, config, mailfile, pool, interactive, timings):
+        nonlocal most_in_flight
+        with lock:
+            in_flight.append(mailfile)
+            most_in_flight = max(most_in_flight, len(in_flight))
+        time.sleep(0.01)
+        with lock:
+            in_flight.remove(mailfile)
+        if mailfile.name == "2.eml":
+            raise wemail.WEmailDeliveryError("Nope")
+        return True
+
+    with mock.patch("builtins.input", return_value="y"), mock.patch(
+        "wemail.send", side_effect=fake_send
+    ):
+        wemail.send_all(config=outbox_config, jobs=4)
+
+    out = capsys.readouterr().out
+    assert most_in_flight == 1
+    assert "FAILED 2.eml - Nope" in out
+    assert out.count("OK     ") == 5
+    assert "1 of 6 failed" in out
+
+
+def test_send_all_should_report_any_error_and_declined_sends_per_file(
+    outbox_config, capsys
+):
+    def fake_send(*, config, mailfile, pool, interactive, timings):
+        if mailfile.name == "1.eml":
+            raise ValueError("Bad attachment header")
+        return mailfile.name != "2.eml"
+
+    with mock.patch("builtins.input", return_value="y"), mock.patch(
+        "wemail.send", side_effect=fake_send
+    ):
+        wemail.send_all(config=outbox_config)
+
+    out = capsys.readouterr().out
+    assert "FAILED 1.eml - Bad attachment header" in out
+    assert "SKIP   2.eml" in out
+    assert out.count("OK     ") == 4
+    assert "1 of 6 skipped" in out
+    assert "1 of 6 failed" in out
+
+
+def test_send_async_should_report_a_declined_mailing_list_as_skipped(
+    outbox_config, mailing_list_mailfile, test_server
+):
+    with mock.patch("builtins.input", return_value="n"):
+        sent = wemail.send(
+            config=outbox_config, mailfile=mailing_list_mailfile, use_async=True
+        )
+
+    assert sent is False
+    assert mailing_list_mailfile.exists()
+    assert not test_server.handler.box
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_rejected_message_should_raise_delivery_error_with_either_engine(
+    outbox_config, rejecting_test_server, use_async
+):
+    outbox_config["SMTP_PORT"] = rejecting_test_server.port
+    mailfile = outbox_config["maildir"] / "outbox" / "0.eml"
+
+    with pytest.raises(wemail.WEmailDeliveryError):
+        wemail.send(
+            config=outbox_config,
+            mailfile=mailfile,
+            interactive=False,
+            use_async=use_async,
+        )
+
+    assert mailfile.exists()
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_starttls_should_use_the_same_ssl_policy_with_either_engine(
+    outbox_config, ssl_test_server, use_async
+):
+    outbox_config["SMTP_HOST"] = ssl_test_server.hostname
+    outbox_config["SMTP_PORT"] = ssl_test_server.port
+    outbox_config["SMTP_USE_TLS"] = True
+    outbox_config["SMTP_USERNAME"] = "fnord"
+    outbox_config["SMTP_PASSWORD"] = "fnord"
+
+    wemail.send(
+        config=outbox_config,
+        mailfile=outbox_config["maildir"] / "outbox" / "0.eml",
+        interactive=False,
+        use_async=use_async,
+    )
+
+    assert len(ssl_test_server.handler.box) == 1
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_message_refused_by_every_recipient_should_stay_put_with_either_engine(
+    outbox_config, limited_test_server, use_async
+):
+    outbox_config["SMTP_PORT"] = limited_test_server.port
+    mailfile = outbox_config["maildir"] / "outbox" / "0.eml"
+    msg = wemail._parser.parsebytes(mailfile.read_bytes())
+    msg.replace_header("To", "nobody@example.com")
+    mailfile.write_bytes(msg.as_bytes())
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        wemail.send(
+            config=outbox_config,
+            mailfile=mailfile,
+            interactive=False,
+            use_async=use_async,
+        )
+
+    assert mailfile.exists()
+    assert not list((outbox_config["maildir"] / "sent").iterdir())
+
+
+class PipeliningHandler:
+    def __init__(self):
+        self.box = []
+
+    async def handle_DATA(self, server, session, envelope):
+        self.box.append(envelope)
+        return "250 OK"
+
+    async def handle_EHLO(self, server, session, envelope, hostname, responses):
+        session.host_name = hostname
+        return responses[:-1] + ["250-PIPELINING", responses[-1]]
+
+
+@pytest.fixture(params=["PLAIN", "LOGIN"])
+def auth_test_server(request):
+    from aiosmtpd.smtp import AuthResult
+
+    def authenticator(server, session, envelope, mechanism, auth_data):
+        return AuthResult(
+            success=(auth_data.login, auth_data.password) == (b"fnord", b"secret")
+        )
+
+    handler = PipeliningHandler()
+    controller = Controller(
+        handler,
+        port=8175,
+        auth_require_tls=False,
+        auth_exclude_mechanism=[m for m in ("PLAIN", "LOGIN") if m != request.param],
+        authenticator=authenticator,
+    )
+    controller.handler = handler
+    controller.start()
+    try:
+        yield controller
+    finally:
+        controller.stop()
+
+
+def test_async_smtp_should_log_in_and_pipeline_a_message(auth_test_server):
+    msg = next(make_test_messages(1))
+    msg["Cc"] = "them@example.com"
+    msg["Bcc"] = "secret@example.com"
+    envelope = wemail.make_envelope(msg)
+
+    async def send():
+        smtp = wemail.AsyncSMTP(
+            smtp_host=auth_test_server.hostname,
+            smtp_port=auth_test_server.port,
+            username="fnord",
+            password="secret",
+        )
+        await smtp.connect()
+        assert "PIPELINING" in smtp.extensions
+        refused = await smtp.sendmail(*envelope)
+        await smtp.quit()
+        return refused
+
+    assert asyncio.run(send()) == {}
+    (actual,) = auth_test_server.handler.box
+    assert actual.rcpt_tos == [
+        "you@example.com",
+        "them@example.com",
+        "secret@example.com",
+    ]
+    assert b"secret@example.com" not in actual.content
+    body = wemail._parser.parsebytes(actual.content).get_content()
+    assert body.strip() == "Message 0"
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_either_engine_should_ask_for_8bitmime_when_the_server_has_it(
+    auth_test_server, use_async
+):
+    envelope = wemail.make_envelope(next(make_test_messages(1)))
+    settings = {
+        "smtp_host": auth_test_server.hostname,
+        "smtp_port": auth_test_server.port,
+        "username": "fnord",
+        "password": "secret",
+    }
+
+    if use_async:
+
+        async def send():
+            async with wemail.AsyncSMTPPool() as pool:
+                return await pool.sendmail(envelope, **settings)
+
+        assert asyncio.run(send()) == {}
+    else:
+        with wemail.SMTPPool() as pool:
+            assert pool.sendmail(envelope, **settings) == {}
+
+    (actual,) = auth_test_server.handler.box
+    assert "BODY=8BITMIME" in actual.mail_options
+
+
+def test_send_all_async_should_send_everything(outbox_config, test_server, capsys):
+    with mock.patch("builtins.input", return_value="y"):
+        wemail.send_all(config=outbox_config, use_async=True)
+
+    assert len(test_server.handler.box) == 6
+    assert not list((outbox_config["maildir"] / "outbox").iterdir())
+    assert len(list((outbox_config["maildir"] / "sent").iterdir())) == 6
+    assert capsys.readouterr().out.count("OK     ") == 6
+
+
+def test_send_async_should_fan_out_a_mailing_list(
+    outbox_config, mailing_list_mailfile, test_server
+):
+    recipients = outbox_config["mailing_list"]["friends"]
+
+    wemail.send(
+        config=outbox_config,
+        mailfile=mailing_list_mailfile,
+        interactive=False,
+        use_async=True,
+    )
+
+    actual = sorted(
+        wemail._parser.parsebytes(e.content)["To"] for e in test_server.handler.box
+    )
+    assert actual == sorted(recipients)
+    assert not mailing_list_mailfile.exists()
+
+
+class RecipientLimitHandler(MyHandler):
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):
+        if len(envelope.rcpt_tos) >= 2:
+            return "452 4.5.3 Too many recipients"
+        if address.startswith("nobody"):
+            return "550 5.1.1 No such user"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+
+@pytest.fixture()
+def limited_test_server():
+    handler = RecipientLimitHandler()
+    controller = Controller(handler, port=8176)
+    controller.handler = handler
+    controller.start()
+    try:
+        yield controller
+    finally:
+        controller.stop()
+
+
+@pytest.fixture()
+def mailing_list_mailfile(outbox_config):
+    outbox_config["mailing_list"] = {
+        "friends": [f"Person {i} <person{i}@example.com>" for i in range(5)]
+        + ["nobody@example.com"]
+    }
+    mailfile = outbox_config["maildir"] / "outbox" / "0.eml"
+    msg = wemail._parser.parsebytes(mailfile.read_bytes())
+    msg["X-MailingList"] = "friends"
+    mailfile.write_bytes(msg.as_bytes())
+    return mailfile
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_bulk_mailing_list_should_batch_recipients_in_the_envelope(
+    outbox_config, mailing_list_mailfile, limited_test_server, use_async, capsys
+):
+    outbox_config["SMTP_PORT"] = limited_test_server.port
+    outbox_config["MAILING_LIST_MODE"] = "bulk"
+    outbox_config["MAILING_LIST_BATCH_SIZE"] = 4
+
+    wemail.send(
+        config=outbox_config,
+        mailfile=mailing_list_mailfile,
+        interactive=False,
+        use_async=use_async,
+    )
+
+    box = limited_test_server.handler.box
+    assert [e.rcpt_tos for e in box] == [
+        ["person0@example.com", "person1@example.com"],
+        ["person2@example.com", "person3@example.com"],
+        ["person4@example.com"],
+    ]
+    assert len({e.content for e in box}) == 1
+    assert wemail._parser.parsebytes(box[0].content)["To"] == "undisclosed-recipients:;"
+    assert "nobody@example.com refused - 550" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_bulk_mailing_list_should_fail_if_every_recipient_is_refused(
+    outbox_config, mailing_list_mailfile, limited_test_server, use_async
+):
+    outbox_config["SMTP_PORT"] = limited_test_server.port
+    outbox_config["MAILING_LIST_MODE"] = "bulk"
+    outbox_config["mailing_list"]["friends"] = [
+        "nobody@example.com",
+        "nobody.else@example.com",
+    ]
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        wemail.send(
+            config=outbox_config,
+            mailfile=mailing_list_mailfile,
+            interactive=False,
+            use_async=use_async,
         )
 
+    assert mailing_list_mailfile.exists()
+
+
+@pytest.mark.parametrize("use_async", [False, True])
+def test_bulk_mailing_list_should_raise_delivery_error_when_rejected(
+    outbox_config, mailing_list_mailfile, rejecting_test_server, use_async
+):
+    outbox_config["SMTP_PORT"] = rejecting_test_server.port
+    outbox_config["MAILING_LIST_MODE"] = "bulk"
+
+    with pytest.raises(wemail.WEmailDeliveryError):
+        wemail.send(
+            config=outbox_config,
+            mailfile=mailing_list_mailfile,
+            interactive=False,
+            use_async=use_async,
+        )
+
+    assert mailing_list_mailfile.exists()
+
+
+def make_merge_message(cte):
+    msg = wemail.EmailMessage(policy=wemail.POLICY)
+    msg["From"] = "me@example.com"
+    msg["To"] = "list@example.com"
+    msg["Subject"] = "For {{name}}"
+    msg.set_content("Hi {{name}},\n\nThis went to {{to}} at {{email}}.\n", cte=cte)
+    msg.add_attachment(
+        bytes(range(256)) * 10,
+        maintype="application",
+        subtype="octet-stream",
+        filename="blob.bin",
+    )
+    return msg
+
+
+@pytest.mark.parametrize(
+    "cte,recipient,flattens",
+    [
+        ("7bit", "Person Man <person@example.com>", 1),
+        ("quoted-printable", "Person Man <person@example.com>", 2),
+        ("7bit", "P\N{LATIN SMALL LETTER E WITH ACUTE}rson <person@example.com>", 2),
+    ],
+)
+def test_merged_envelopes_should_fill_in_each_recipient(cte, recipient, flattens):
+    msg = make_merge_message(cte)
+    attachment = next(msg.iter_attachments()).get_content()
+    recipients = ["Other <other@example.com>", recipient]
+
+    with mock.patch("wemail.make_envelope", wraps=wemail.make_envelope) as fake:
+        envelopes = list(wemail.iter_merged_envelopes(msg, recipients))
+
+    assert fake.call_count == flattens
+    assert [e.to_addrs for e in envelopes] == [
+        ["other@example.com"],
+        ["person@example.com"],
+    ]
+    actual = wemail._parser.parsebytes(envelopes[1].data)
+    name = wemail.parseaddr(recipient)[0]
+    assert actual["To"] == recipient
+    assert actual["Subject"] == f"For {name}"
+    assert actual.get_body().get_content().replace("\r\n", "\n") == (
+        f"Hi {name},\n\nThis went to {recipient} at person@example.com.\n"
+    )
+    assert next(actual.iter_attachments()).get_content() == attachment
+
+
+def test_merged_envelopes_should_not_splice_into_an_encoded_word():
+    msg = wemail._parser.parsebytes(
+        b"From: me@example.com\nTo: list@example.com\n"
+        b"Subject: =?utf-8?q?Caf=C3=A9_for_{{name}}?=\n\nHi {{name}}\n"
+    )
+
+    with mock.patch("wemail.make_envelope", wraps=wemail.make_envelope) as fake:
+        (envelope,) = wemail.iter_merged_envelopes(msg, ["Person Man <p@example.com>"])
+
+    assert fake.call_count == 2
+    actual = wemail._parser.parsebytes(envelope.data)
+    assert actual["Subject"] == "Caf\N{LATIN SMALL LETTER E WITH ACUTE} for Person Man"
+
+
+def test_merge_mailing_list_should_raise_delivery_error_when_rejected(
+    outbox_config, mailing_list_mailfile, rejecting_test_server
+):
+    outbox_config["SMTP_PORT"] = rejecting_test_server.port
+    outbox_config["MAILING_LIST_MODE"] = "merge"
+
+    with pytest.raises(wemail.WEmailDeliveryError):
+        wemail.send(
+            config=outbox_config, mailfile=mailing_list_mailfile, interactive=False
+        )
+
+    assert mailing_list_mailfile.exists()
+
+
+def test_merge_mailing_list_should_send_everyone_their_own_message(
+    outbox_config, mailing_list_mailfile, test_server
+):
+    outbox_config["MAILING_LIST_MODE"] = "merge"
+    recipients = outbox_config["mailing_list"]["friends"]
+
+    wemail.send(config=outbox_config, mailfile=mailing_list_mailfile, interactive=False)
+
+    box = test_server.handler.box
+    assert [e.rcpt_tos for e in box] == [[wemail.parseaddr(r)[1]] for r in recipients]
+    assert [wemail._parser.parsebytes(e.content)["To"] for e in box] == recipients
+
+
+def test_merge_mailing_list_should_report_refused_recipients(
+    outbox_config, mailing_list_mailfile, limited_test_server, capsys
+):
+    outbox_config["SMTP_PORT"] = limited_test_server.port
+    outbox_config["MAILING_LIST_MODE"] = "merge"
+
+    with mock.patch("builtins.input", return_value="y"):
+        wemail.send(config=outbox_config, mailfile=mailing_list_mailfile)
+
+    out = capsys.readouterr().out
+    assert "Sending to nobody@example.com...REFUSED" in out
+    assert "nobody@example.com refused - 550 5.1.1 No such user" in out
+    assert len(limited_test_server.handler.box) == 5
+    assert not mailing_list_mailfile.exists()
+
+
+def test_merge_mailing_list_should_fail_if_every_recipient_is_refused(
+    outbox_config, mailing_list_mailfile, limited_test_server
+):
+    outbox_config["SMTP_PORT"] = limited_test_server.port
+    outbox_config["MAILING_LIST_MODE"] = "merge"
+    outbox_config["mailing_list"]["friends"] = ["nobody@example.com"]
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        wemail.send(
+            config=outbox_config, mailfile=mailing_list_mailfile, interactive=False
+        )
+
+    assert mailing_list_mailfile.exists()
+
+
+def test_unknown_mailing_list_mode_should_fail_before_sending(
+    outbox_config, mailing_list_mailfile
+):
+    outbox_config["MAILING_LIST_MODE"] = "blast"
+
+    with mock.patch("wemail.send_message") as fake_send, pytest.raises(
+        wemail.WEmailError
+    ):
+        wemail.send(
+            config=outbox_config, mailfile=mailing_list_mailfile, interactive=False
+        )
+
+    fake_send.assert_not_called()
+
 
 def test_send_should_move_mailfile_to_sent_after_success(sample_good_mailfile):
     sent_dir = sample_good_mailfile.parent.parent / "sent"
     expected_text = sample_good_mailfile.read_text()
 
-    with mock.patch("wemail.send_message", autospec=True):
+    with mock.patch("wemail.send_raw", autospec=True):
         wemail.send(
             config={"maildir": sample_good_mailfile.parent.parent},
             mailfile=sample_good_mailfile,
@@ -963,6 +2148,35 @@ def test_send_should_move_mailfile_to_sent_after_success(sample_good_mailfile):
     assert actual_text == expected_text
 
 
+@pytest.mark.parametrize("use_async", [False, True])
+def test_attachments_should_be_streamed_from_a_spool_to_every_recipient(
+    outbox_config, mailing_list_mailfile, test_server, use_async
+):
+    expected_content = os.urandom(200_000)
+    with tempfile.TemporaryDirectory() as td:
+        attachment = pathlib.Path(td, "big.bin")
+        attachment.write_bytes(expected_content)
+        msg = wemail._parser.parsebytes(mailing_list_mailfile.read_bytes())
+        msg["Attachment"] = str(attachment)
+        mailing_list_mailfile.write_bytes(msg.as_bytes())
+
+        with mock.patch("wemail.SPOOL_SIZE", 1000):
+            wemail.send(
+                config=outbox_config,
+                mailfile=mailing_list_mailfile,
+                interactive=False,
+                use_async=use_async,
+            )
+
+    box = test_server.handler.box
+    assert len(box) == 6
+    for envelope in box:
+        received = wemail._parser.parsebytes(envelope.content)
+        (part,) = received.iter_attachments()
+        assert part.get_filename() == "big.bin"
+        assert part.get_content() == expected_content
+
+
 # End send meessages }}}
 
 # {{{ Reply email tests
@@ -1328,6 +2542,244 @@ def test_when_filename_is_a_dir_and_force_is_passed_it_should_overwrite_files_wi
         assert samplefile.read_text() == expected_text
 
 
+def test_save_attachment_should_number_parts_like_read(
+    multipart_email, good_loaded_config
+):
+    curdir = good_loaded_config["maildir"] / "cur"
+    (curdir / "parts.eml").write_bytes(multipart_email.as_bytes())
+    good_loaded_config["curdir"] = curdir
+    expected = next(multipart_email.iter_attachments()).get_content()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        wemail.save_attachment(
+            config=good_loaded_config, mailnumber="1", part=3, name=tempdir
+        )
+
+        assert pathlib.Path(tempdir, "blob.bin").read_bytes() == expected
+
+
+def test_save_attachment_should_stream_without_parsing_the_message(good_loaded_config):
+    msg = wemail.EmailMessage(policy=wemail.POLICY)
+    msg["Subject"] = "Big"
+    msg.set_content("see attached")
+    msg.add_attachment(
+        "caf\N{LATIN SMALL LETTER E WITH ACUTE}\n" * 5000,
+        filename="notes.txt",
+        charset="latin-1",
+        cte="quoted-printable",
+    )
+    msg.add_attachment(
+        bytes(range(256)) * 1000,
+        maintype="application",
+        subtype="octet-stream",
+        filename="blob.bin",
+    )
+    curdir = good_loaded_config["maildir"] / "cur"
+    (curdir / "big.eml").write_bytes(msg.as_bytes())
+    good_loaded_config["curdir"] = curdir
+    expected_text, expected_blob = (p.get_content() for p in msg.iter_attachments())
+
+    with tempfile.TemporaryDirectory() as tempdir, mock.patch(
+        "wemail._parser"
+    ) as fake_parser:
+        for part in (2, 3):
+            wemail.save_attachment(
+                config=good_loaded_config, mailnumber="1", part=part, name=tempdir
+            )
+
+        assert pathlib.Path(tempdir, "notes.txt").read_text() == expected_text
+        assert pathlib.Path(tempdir, "blob.bin").read_bytes() == expected_blob
+    fake_parser.parsebytes.assert_not_called()
+
+
+@pytest.fixture()
+def attachments_config(multipart_email, good_loaded_config):
+    multipart_email.add_attachment(
+        b"more bytes", maintype="application", subtype="pdf", filename="blob.bin"
+    )
+    multipart_email.add_attachment("notes", filename="notes.txt")
+    curdir = good_loaded_config["maildir"] / "cur"
+    (curdir / "parts.eml").write_bytes(multipart_email.as_bytes())
+    good_loaded_config["curdir"] = curdir
+    return good_loaded_config
+
+
+def test_listing_a_folder_should_not_read_message_bodies(attachments_config):
+    with mock.patch("wemail.map_mailfile") as fake_map, mock.patch(
+        "sys.stdout", new_callable=io.StringIO
+    ):
+        wemail.list_messages(config=attachments_config)
+
+    fake_map.assert_not_called()
+
+
+def test_parts_should_show_the_structure_from_the_index(attachments_config, capsys):
+    wemail.show_parts(config=attachments_config, mailnumber="1")
+    capsys.readouterr()
+
+    with mock.patch("wemail.map_mailfile") as fake_map:
+        wemail.show_parts(config=attachments_config, mailnumber="1")
+
+    fake_map.assert_not_called()
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[:3] == [
+        "multipart/mixed",
+        "  multipart/alternative",
+        "    1. text/plain (240 B)",
+    ]
+    assert lines[4].startswith("  3. application/octet-stream blob.bin (25.")
+    assert lines[6] == "  5. text/plain notes.txt (6 B)"
+
+
+def test_list_with_attachments_should_only_list_messages_with_attachments(
+    attachments_config, capsys
+):
+    curdir = attachments_config["curdir"]
+    for i in range(3):
+        (curdir / f"plain{i}.eml").write_text(
+            f"Date: Sat, 0{i + 1} Aug 2099 12:00:00 +0000\nSubject: {i}\n\nHi"
+        )
+
+    wemail.list_messages(config=attachments_config, with_attachments=True)
+
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 4
+    assert lines[0].startswith(" 1. ")
+    assert lines[0].endswith(" - Parts")
+    assert [line.split(".", 1)[0].strip() for line in lines[1:]] == ["3", "4", "5"]
+
+
+def test_parts_should_be_summarized_again_when_the_file_changes(
+    attachments_config, capsys
+):
+    mailfile = attachments_config["curdir"] / "parts.eml"
+    wemail.show_parts(config=attachments_config, mailnumber="1")
+    capsys.readouterr()
+    mailfile.write_text("Subject: Parts\n\nJust text now")
+
+    wemail.show_parts(config=attachments_config, mailnumber="1")
+
+    assert capsys.readouterr().out == "1. text/plain (13 B)\n"
+
+
+def test_save_attachment_with_all_should_zip_every_attachment(
+    attachments_config, multipart_email
+):
+    expected = [p.get_payload(decode=True) for p in multipart_email.iter_attachments()]
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        wemail.save_attachment(
+            config=attachments_config, mailnumber="1", part="all", name=tempdir
+        )
+
+        with zipfile.ZipFile(pathlib.Path(tempdir, "attachments.zip")) as archive:
+            assert archive.namelist() == ["blob.bin", "4-blob.bin", "notes.txt"]
+            assert [archive.read(n) for n in archive.namelist()] == expected
+
+
+def test_save_all_attachments_should_only_spool_a_few_parts_at_once():
+    msg = wemail.EmailMessage(policy=wemail.POLICY)
+    msg.set_content("Lots of attachments")
+    for i in range(10):
+        msg.add_attachment(
+            bytes([i]) * 1000,
+            maintype="application",
+            subtype="octet-stream",
+            filename=f"{i}.bin",
+        )
+    data = msg.as_bytes()
+    parts = list(enumerate(wemail.leaf_parts(wemail.mime_tree(data)), start=1))[1:]
+    lock = threading.Lock()
+    live = 0
+    most_live = 0
+
+    class Spool(io.BytesIO):
+        def close(self):
+            nonlocal live
+            with lock:
+                if not self.closed:
+                    live -= 1
+            super().close()
+
+    def fake_spool(data, part):
+        nonlocal live, most_live
+        with lock:
+            live += 1
+            most_live = max(most_live, live)
+        return Spool(b"".join(wemail.iter_decoded(data, part)))
+
+    with tempfile.TemporaryDirectory() as tempdir, mock.patch(
+        "wemail.DECODE_JOBS", 2
+    ), mock.patch("wemail._spool_part", side_effect=fake_spool):
+        wemail.save_all_attachments(data=data, parts=parts, name=tempdir)
+
+        with zipfile.ZipFile(pathlib.Path(tempdir, "attachments.zip")) as archive:
+            assert archive.read("9.bin") == bytes([9]) * 1000
+
+    assert live == 0
+    assert most_live <= 3
+
+
+def test_save_attachment_with_all_and_nozip_should_save_files_to_the_dir(
+    attachments_config, multipart_email
+):
+    expected = [p.get_payload(decode=True) for p in multipart_email.iter_attachments()]
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        wemail.save_attachment(
+            config=attachments_config,
+            mailnumber="1",
+            part="all",
+            name=tempdir,
+            nozip=True,
+        )
+
+        actual = [
+            pathlib.Path(tempdir, n).read_bytes()
+            for n in ["blob.bin", "4-blob.bin", "notes.txt"]
+        ]
+        assert actual == expected
+
+
+@pytest.mark.parametrize("nozip", [False, True])
+def test_save_attachment_with_all_should_keep_files_inside_the_target(
+    good_loaded_config, nozip
+):
+    msg = wemail.EmailMessage()
+    msg["Subject"] = "Sneaky"
+    msg.set_content("Look")
+    for fname in ("../escaped.txt", "/tmp/absolute.txt", ".."):
+        msg.add_attachment("x", filename=fname)
+    curdir = good_loaded_config["maildir"] / "cur"
+    (curdir / "sneaky.eml").write_bytes(msg.as_bytes())
+    good_loaded_config["curdir"] = curdir
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        target = pathlib.Path(tempdir, "out")
+        target.mkdir()
+        wemail.save_attachment(
+            config=good_loaded_config,
+            mailnumber="1",
+            part="all",
+            name=target,
+            nozip=nozip,
+            force=True,
+        )
+
+        if nozip:
+            names = sorted(path.name for path in target.iterdir())
+        else:
+            with zipfile.ZipFile(target / "attachments.zip") as archive:
+                names = sorted(archive.namelist())
+        assert names == ["absolute.txt", "escaped.txt", "part-4"]
+        assert [path.name for path in pathlib.Path(tempdir).iterdir()] == ["out"]
+
+
+def test_attachment_part_should_accept_all_or_a_number():
+    assert parser.parse_args(["attachment", "1", "-p", "all"]).part == "all"
+    assert parser.parse_args(["attachment", "1", "-p", "2"]).part == 2
+
+
 def test_when_no_matching_part_is_found_error_message_should_be_shown(
     good_loaded_config
 ):
@@ -1365,6 +2817,16 @@ def test_if_no_commonmark_header_commonmarkdown_should_return_msg(good_draft):
     assert msg is good_draft
 
 
+def test_commonmarkdown_should_change_the_msg_in_place(good_draft):
+    good_draft["X-CommonMark"] = "True"
+    good_draft.set_content("fnord")
+
+    msg = wemail.commonmarkdown(good_draft)
+
+    assert msg is good_draft
+    assert good_draft.get_content_type() == "multipart/alternative"
+
+
 # }}}
 
 # {{{ attachify tests
@@ -1389,6 +2851,8 @@ def test_attachify_should_attach_text_file_with_proper_type(good_draft):
 
         attachment = next(msg.iter_attachments())
 
+        assert msg is good_draft
+        assert "Attachment" not in msg
         assert attachment.get_content_type() == "text/plain"
         assert attachment.get_content() == expected_content
 
@@ -1463,6 +2927,30 @@ def test_attachify_with_audio_file_should_attach_with_audio(good_draft):
         assert attachment.get_filename() == file.name
 
 
+def test_spool_attachments_should_encode_the_files_a_chunk_at_a_time(good_draft):
+    good_draft.set_content("See attached")
+    with tempfile.TemporaryDirectory() as td:
+        file = pathlib.Path(td, "fnord.txt")
+        expected_content = b"".join(b"line %d\n" % i for i in range(1000))
+        file.write_bytes(expected_content)
+        good_draft["Attachment"] = f'{file}; name="notes.txt"'
+
+        with mock.patch("wemail.SPOOL_SIZE", 1000):
+            attachments = wemail.spool_attachments(good_draft, chunk_size=57 * 3)
+
+    envelope = wemail.with_attachments(wemail.make_envelope(good_draft), attachments)
+    attachments.file.seek(0)
+    msg = wemail._parser.parsebytes(envelope.data + attachments.file.read())
+    attachment = next(msg.iter_attachments())
+
+    assert envelope.tail is attachments.file
+    assert attachments.file._rolled
+    assert "Attachment" not in good_draft
+    assert attachment.get_filename() == "notes.txt"
+    assert attachment.get_content().encode() == expected_content
+    assert msg.get_body(("plain",)).get_content().strip() == "See attached"
+
+
 # }}}
 
 # {{{ forwardify tests
@@ -1623,6 +3111,45 @@ def test_get_msg_date_should_use_present_timezone_if_present_on_date(temp_maildi
     assert date.tzinfo == wemail.timezone(datetime.timedelta(hours=-6))
 
 
+@pytest.mark.parametrize(
+    "value",
+    [
+        "Sat, 8 Jun 2019 11:45:15 -0600",
+        "Sat, 08 Jun 2019 11:45:15 +0530",
+        "8 Jun 2019 11:45:15 -0000",
+        "Sat, 8 JUN 2019 23:59:59 +0000",
+        "Sat, 8 Jun 2019 11:45 -0600",
+        "Sat, 8 Jun 2019 11:45:15 GMT",
+        "Sat, 8 Jun 2019 11:45:15",
+    ],
+)
+def test_parse_msg_date_should_agree_with_the_email_parser(value):
+    expected = wemail.parsedate_to_datetime(value)
+    if expected.tzinfo is None:
+        expected = expected.replace(tzinfo=wemail.timezone.utc)
+
+    actual = wemail.parse_msg_date(value)
+
+    assert actual == expected
+    assert actual.utcoffset() == expected.utcoffset()
+    assert wemail.date_key(value) == int(expected.timestamp())
+
+
+def test_date_key_should_only_parse_each_date_once():
+    wemail.parse_msg_date.cache_clear()
+    wemail.date_key.cache_clear()
+    value = "Sat, 8 Jun 2019 11:45 -0600"
+
+    with mock.patch(
+        "wemail.parsedate_to_datetime", wraps=wemail.parsedate_to_datetime
+    ) as fake_parse:
+        keys = {wemail.date_key(value) for _ in range(3)}
+        wemail.parse_msg_date(value)
+
+    assert len(keys) == 1
+    fake_parse.assert_called_once_with(value)
+
+
 # }}} end get_msg_date tests
 
 # {{{ pretty_recipients tests
@@ -1,22 +1,41 @@
 import argparse
 import ast
+import asyncio
+import base64
+import binascii
+import codecs
 import collections
+import contextlib
+import copy
+import functools
+import hashlib
+import heapq
 import quopri
 import io
 import json
 import logging
 import mimetypes
+import mmap
 import os
 import re
 import shutil
 import smtplib
+import socket
+import sqlite3
+import ssl
 import subprocess
 import sys
 import tempfile
+import threading
 import time
+import zipfile
 from cmd import Cmd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from datetime import timedelta
 from datetime import timezone
+from email.generator import BytesGenerator
 from email.header import decode_header
 from email.message import EmailMessage
 from email.mime.application import MIMEApplication
@@ -66,6 +85,81 @@ _header_parser = BytesHeaderParser(policy=POLICY)
 DEFAULT_HEADERS = {"From": "", "To": "", "Subject": ""}
 DISPLAY_HEADERS = ("From", "To", "CC", "Reply-to", "List-Id", "Date", "Subject")
 EmailTemplate = collections.namedtuple("EmailTemplate", "name,content")
+MailRecord = collections.namedtuple(
+    "MailRecord",
+    "path,short_id,timestamp,date,sender,subject,message_id,size,parts",
+)
+PartSummary = collections.namedtuple("PartSummary", "depth,content_type,filename,size")
+# ``tail``, if there is one, is a binary file that's sent after ``data``.
+Envelope = collections.namedtuple(
+    "Envelope", "from_addr,to_addrs,data,tail", defaults=(None,)
+)
+AttachmentFile = collections.namedtuple(
+    "AttachmentFile", "path,name,maintype,subtype,disposition"
+)
+SpooledAttachments = collections.namedtuple("SpooledAttachments", "boundary,file")
+Outgoing = collections.namedtuple(
+    "Outgoing", "config,msg,recipients,sentfile,attachments"
+)
+MimePart = collections.namedtuple(
+    "MimePart",
+    "content_type,filename,encoding,charset,start,body_start,end,depth,headers",
+)
+INDEX_FILENAME = ".wemail-index.sqlite3"
+HEADER_CACHE_SIZE = 4096
+LIST_BATCH_SIZE = 1000
+DECODE_CHUNK_SIZE = 64 * 1024
+# Threads decoding attachments, which is also how many decoded parts can
+# be waiting for their turn in a zipfile.
+DECODE_JOBS = os.cpu_count() or 1
+SMTP_MAX_CONNECTIONS = 2
+MAILING_LIST_BATCH_SIZE = 100
+MAILING_LIST_MODES = ("each", "bulk", "merge")
+# Any of these headers means the draft has to be parsed and rewritten
+# before it's sent, rather than sent straight from the file.
+OUTGOING_TRANSFORM_HEADERS = (
+    "X-CommonMark",
+    "Attachment",
+    "X-MailingList",
+    "Bcc",
+    "Resent-Bcc",
+)
+# What send_async and send_all record for a message that wasn't sent
+# because the user said no.
+SKIPPED = object()
+_MERGE_FIELD = re.compile(r"\{\{(to|name|email)\}\}")
+_MERGE_FIELD_BYTES = re.compile(rb"\{\{(to|name|email)\}\}")
+_ENCODED_WORD_BYTES = re.compile(rb"=\?[^?\s]+\?[bBqQ]\?[^?\s]*\?=")
+# A header field, folded lines and all.
+_HEADER_FIELD_BYTES = re.compile(rb"[^\r\n]*(?:\r?\n[ \t][^\r\n]*)*")
+SPOOL_SIZE = 1024 * 1024
+# A multiple of 57 bytes, which base64 encodes to whole 76 character lines.
+ENCODE_CHUNK_SIZE = 57 * 1024
+VIEW_CACHE_SIZE = 64 * 1024 * 1024
+_NOT_BASE64 = bytes(
+    set(range(256))
+    - set(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=")
+)
+INDEX_CHUNK_SIZE = 500
+HEADER_CHUNK_SIZE = 4096
+_HEADER_END = re.compile(rb"(?:\A|\n)\r?\n")
+DATE_CACHE_SIZE = 8192
+# The shape nearly every mailer uses: Day, DD Mon YYYY HH:MM:SS +ZZZZ
+_FAST_DATE = re.compile(
+    r"(?:[A-Za-z]{3}, )?(\d{1,2}) ([A-Za-z]{3}) (\d{4})"
+    r" (\d{2}):(\d{2}):(\d{2}) ([+-])(\d{2})(\d{2})"
+)
+_MONTHS = {
+    name: number
+    for number, name in enumerate(
+        "jan feb mar apr may jun jul aug sep oct nov dec".split(), start=1
+    )
+}
+SHORT_ID_LENGTH = 10
+# Short ids are hex digests with the digits swapped out for letters, so
+# they can never be confused with a message number.
+_SHORT_ID_TRANS = str.maketrans("0123456789", "ghijklmnop")
+_SHORT_ID_CHARS = frozenset("abcdefghijklmnop")
 LOCAL_TZ = datetime.now(timezone.utc).astimezone().tzinfo
 
 
@@ -101,11 +195,44 @@ def make_parser():
     send_parser = subparsers.add_parser("send", help="Send specific email.")
     send_parser.set_defaults(action="send")
     send_parser.add_argument("mailfile", type=Path)
+    send_parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=False,
+        help="Send with the asyncio engine - mailing lists go out over SMTP_MAX_CONNECTIONS connections at once.",
+    )
+    send_parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=False,
+        help="Show how long each stage of sending took.",
+    )
 
     sendall_parser = subparsers.add_parser(
         "send_all", help="Send all emails in outbox."
     )
     sendall_parser.set_defaults(action="send_all")
+    sendall_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of messages to send at once. Each server gets at most SMTP_MAX_CONNECTIONS of them.",
+    )
+    sendall_parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        default=False,
+        help="Send everything at once with the asyncio engine, over at most SMTP_MAX_CONNECTIONS connections per server.",
+    )
+    sendall_parser.add_argument(
+        "--timings",
+        action="store_true",
+        default=False,
+        help="Show how long each stage of sending took, over all the messages.",
+    )
 
     check_parser = subparsers.add_parser("check", help="Check for new email.")
     check_parser.set_defaults(action="check")
@@ -122,7 +249,9 @@ def make_parser():
         "reply", help="Reply to reply-to or sender of an email."
     )
     reply_parser.set_defaults(action="reply")
-    reply_parser.add_argument("mailfile", type=Path)
+    reply_parser.add_argument(
+        "mailfile", type=Path, help="Mail file, message number, or message id."
+    )
     reply_parser.add_argument(
         "--keep-attachments",
         action="store_true",
@@ -145,6 +274,60 @@ def make_parser():
         "list", help="List the messages - date, sender, and subject."
     )
     list_parser.set_defaults(action="list")
+    list_parser.add_argument(
+        "--ids",
+        action="store_true",
+        default=False,
+        help="Show stable message ids, which can be used in place of message numbers.",
+    )
+    list_parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes to use when indexing lots of new messages.",
+    )
+    list_parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="Only list this many of the newest messages.",
+    )
+    list_parser.add_argument(
+        "--offset",
+        type=int,
+        default=0,
+        help="Skip this many of the newest messages.",
+    )
+    list_parser.add_argument(
+        "--since",
+        type=parse_date_arg,
+        default=None,
+        help="Only list messages from this date (YYYY-MM-DD[THH:MM]) or later.",
+    )
+    list_parser.add_argument(
+        "--until",
+        type=parse_date_arg,
+        default=None,
+        help="Only list messages from before this date (YYYY-MM-DD[THH:MM]).",
+    )
+    list_parser.add_argument(
+        "--with-attachments",
+        action="store_true",
+        default=False,
+        help="Only list messages with attachments, and show what they are.",
+    )
+
+    parts_parser = subparsers.add_parser(
+        "parts",
+        help="Show the parts of a message - content types, filenames, and sizes.",
+    )
+    parts_parser.set_defaults(action="parts")
+    parts_parser.add_argument(
+        "mailnumber",
+        type=parse_mailnumber_arg,
+        help="Message number or id to show the parts of.",
+    )
 
     remove_parser = subparsers.add_parser(
         "rm",
@@ -153,14 +336,16 @@ def make_parser():
     remove_parser.set_defaults(action="remove")
     remove_parser.add_argument(
         "mailnumber",
-        help="The message number from the 'list' to delete. Note that message numbers may change when mail is checked, saved, or removed!",
+        type=parse_mailnumber_arg,
+        help="The message number or id from the 'list' to delete. Note that message numbers may change when mail is checked, saved, or removed, but ids from 'list --ids' will not!",
     )
 
     save_parser = subparsers.add_parser("save", help="Save a message.")
     save_parser.set_defaults(action="save", folder="saved-messages")
     save_parser.add_argument(
         "mailnumber",
-        help="Message number to save. Note that message numbers may change when mail is checked, saved, or removed!",
+        type=parse_mailnumber_arg,
+        help="Message number or id to save. Note that message numbers may change when mail is checked, saved, or removed, but ids from 'list --ids' will not!",
     )
     save_parser.add_argument(
         "--folder",
@@ -173,12 +358,14 @@ def make_parser():
     )
     attachment_parser.set_defaults(action="attachment")
     attachment_parser.add_argument(
-        "mailnumber", help="Message number to save the attachments from."
+        "mailnumber",
+        type=parse_mailnumber_arg,
+        help="Message number or id to save the attachments from.",
     )
     attachment_parser.add_argument(
         "-p",
         "--part",
-        type=int,
+        type=parse_part_arg,
         default=None,
         help="Message/attachment part number to save. 'all' will save all attachments in a zipfile. If no part is provided, we'll ask you.",
     )
@@ -202,7 +389,9 @@ def make_parser():
     # TODO: It would be pretty cool to have capability to read emails in different viewer, like html open in a browser -W. Werner, 2019-12-06
     read_parser = subparsers.add_parser("read", help="Read a single message")
     read_parser.set_defaults(action="read")
-    read_parser.add_argument("mailnumber", type=int)
+    read_parser.add_argument(
+        "mailnumber", type=parse_mailnumber_arg, help="Message number or id to read."
+    )
     read_parser.add_argument(
         "--all-headers", help="Provide all headers instead of a limited set."
     )
@@ -222,10 +411,51 @@ def make_parser():
 
     raw_parser = subparsers.add_parser("raw", help="Read a raw/original single message")
     raw_parser.set_defaults(action="raw")
-    raw_parser.add_argument("mailnumber", type=int)
+    raw_parser.add_argument(
+        "mailnumber", type=parse_mailnumber_arg, help="Message number or id to read."
+    )
     return parser
 
 
+def parse_part_arg(value):
+    """
+    Parse a part number, or ``all``, from the command line.
+    """
+    if value.lower() == "all":
+        return "all"
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid part: {value!r}")
+
+
+def parse_mailnumber_arg(value):
+    """
+    Parse a message number, or an id from ``list --ids``, from the
+    command line.
+    """
+    if is_short_id(value):
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid message number or id: {value!r}")
+
+
+def parse_date_arg(value):
+    """
+    Parse an ISO 8601 date from the command line. Dates without a
+    timezone are taken to be local time.
+    """
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {value!r}")
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=LOCAL_TZ)
+    return date
+
+
 def action_prompt():
     choice = input("[s]end now, [q]ueue, sa[v]e draft, [d]iscard? ").lower().strip()
     if choice not in ("s", "q", "v", "d"):
@@ -265,23 +495,72 @@ def subjectify(*, msg):
     return subject
 
 
-def commonmarkdown(plain_msg):
+def commonmarkdown(msg):
     """
-    CommonMark-ify the provided msg. Return a multipart email with
-    both text and HTML parts.
+    CommonMark-ify the provided msg, in place. Return it as a multipart
+    email with both text and HTML parts.
     """
 
-    if "X-CommonMark" not in plain_msg:
-        return plain_msg
-    msg = _parser.parsebytes(plain_msg.as_bytes())
+    if "X-CommonMark" not in msg:
+        return msg
     del msg["X-CommonMark"]
 
-    msg.set_content(msg.get_content())
+    text = msg.get_content()
+    msg.set_content(text)
     msg.make_alternative()
-    msg.add_alternative(commonmark(plain_msg.get_payload()), subtype="html")
+    msg.add_alternative(commonmark(text), subtype="html")
     return msg
 
 
+def parse_attachment(header):
+    """
+    Return the ``AttachmentFile`` for an Attachment ``header`` - see
+    ``attachify``.
+    """
+    filename, *extra = header.split(";")
+    path = Path(filename).expanduser().resolve()
+    name = path.name
+    type_, encoding = mimetypes.guess_type(path.name)
+    maintype, _, subtype = (type_ or "application/octet-stream").partition("/")
+    disposition = "attachment"
+    for bit in extra:
+        key, _, val = bit.strip().partition("=")
+        key = key.strip()
+        val = val.strip()
+        if key.lower() == "inline" and val.lower() == "true":
+            disposition = "inline"
+        elif key.lower() in ("name", "filename"):
+            name = ast.literal_eval(val)
+    return AttachmentFile(
+        path=path,
+        name=name,
+        maintype=maintype,
+        subtype=subtype,
+        disposition=disposition,
+    )
+
+
+def _attachment_part(attachment, content):
+    part = EmailMessage(policy=POLICY)
+    part.set_content(
+        content,
+        filename=attachment.name,
+        maintype=attachment.maintype,
+        subtype=attachment.subtype,
+        disposition=attachment.disposition,
+    )
+    part.add_header("Content-ID", f"<{attachment.name}>")
+    part.add_header("X-Attachment-Id", attachment.name)
+    return part
+
+
+def _make_mixed(msg):
+    if msg.get_content_type() != "multipart/mixed":
+        # An HTML alternative goes alongside the attachments, not with them.
+        msg.make_mixed()
+        msg.preamble = "This is a MIME-formatted multi-part message."
+
+
 def attachify(msg):
     """
     Seek for attachment headers. If any exist, attach files. If ``; name=``
@@ -292,45 +571,161 @@ def attachify(msg):
     ``; inline=true`` must be set to inline the attachment.
 
     If attachment filename does not exist, raise WEmailAttachmentNotFound.
+
+    The files are attached to ``msg`` in place, and it's returned. They're
+    read into memory whole - ``spool_attachments`` doesn't.
     """
-    related_msg = _parser.parsebytes(msg.as_bytes())
-    if not related_msg.is_multipart():
-        related_msg.make_mixed()
-        related_msg.preamble = "This is a MIME-formatted multi-part message."
-    attachments = related_msg.get_all("Attachment")
+    headers = msg.get_all("Attachment")
+    if headers is None:
+        return msg
+    del msg["Attachment"]
+    _make_mixed(msg)
+    for header in headers:
+        attachment = parse_attachment(header)
+        msg.attach(_attachment_part(attachment, attachment.path.read_bytes()))
+    return msg
 
+
+def spool_attachments(msg, *, chunk_size=ENCODE_CHUNK_SIZE):
+    """
+    Like ``attachify``, except the files aren't attached to ``msg``.
+    Instead they're base64 encoded ``chunk_size`` bytes at a time - a
+    multiple of 57, for whole lines - into a spool file, which only stays
+    in memory while it's small. ``msg`` is made multipart with an
+    explicit boundary, and the spool holds the rest of the message: the
+    attachment parts and the closing delimiter. See ``with_attachments``.
+
+    Return ``SpooledAttachments``, or None if there's nothing to attach.
+    """
+    headers = msg.get_all("Attachment")
+    if headers is None:
+        return None
+    attachments = [parse_attachment(header) for header in headers]
+    del msg["Attachment"]
+    _make_mixed(msg)
+    boundary = f"===============wemail{os.urandom(8).hex()}=="
+    msg.set_boundary(boundary)
+    msg.epilogue = None
+    policy = msg.policy.clone(linesep="\r\n")
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+        for attachment in attachments:
+            with open(attachment.path, "rb") as f:
+                spool.write(f"\r\n--{boundary}\r\n".encode())
+                spool.write(_attachment_part(attachment, b"").as_bytes(policy=policy))
+                for chunk in iter(lambda: f.read(chunk_size), b""):
+                    spool.write(base64.encodebytes(chunk).replace(b"\n", b"\r\n"))
+        spool.write(f"\r\n--{boundary}--\r\n".encode())
+    except BaseException:
+        spool.close()
+        raise
+    return SpooledAttachments(boundary=boundary, file=spool)
+
+
+def with_attachments(envelope, attachments):
+    """
+    Return ``envelope``, for a message that went through
+    ``spool_attachments``, with the spooled ``attachments`` as its tail in
+    place of the closing delimiter.
+    """
     if attachments is None:
-        return msg
-    del related_msg["Attachment"]
-
-    attachment_ids = set()
-    for attachment in attachments:
-        filename, *extra = attachment.split(";")
-        filename = Path(filename).expanduser().resolve()
-        name = filename.name
-        type_, encoding = mimetypes.guess_type(filename.name)
-        maintype, _, subtype = (type_ or "application/octet-stream").partition("/")
-        disposition = "attachment"
-        for bit in extra:
-            key, _, val = bit.strip().partition("=")
-            key = key.strip()
-            val = val.strip()
-            if key.lower() == "inline" and val.lower() == "true":
-                disposition = "inline"
-            elif key.lower() in ("name", "filename"):
-                name = ast.literal_eval(val)
-        part = EmailMessage(policy=POLICY)
-        part.set_content(
-            filename.read_bytes(),
-            filename=name,
-            maintype=maintype,
-            subtype=subtype,
-            disposition=disposition,
-        )
-        part.add_header("Content-ID", f"<{name}>")
-        part.add_header("X-Attachment-Id", name)
-        related_msg.attach(part)
-    return related_msg
+        return envelope
+    closing = f"\r\n--{attachments.boundary}--\r\n".encode()
+    if not envelope.data.endswith(closing):
+        raise WEmailError("Message doesn't end where its attachments go")
+    return envelope._replace(data=envelope.data[: -len(closing)], tail=attachments.file)
+
+
+def stamp_date(msg):
+    """
+    Give ``msg`` a Date of now, if it doesn't have one.
+    """
+    if not msg.get("Date"):
+        msg["Date"] = format_datetime(datetime.now(timezone.utc))
+    return msg
+
+
+def outgoing_pipeline():
+    """
+    Return the ``(name, stage)`` pairs that a draft goes through on its
+    way out, in order. Each stage takes the parsed message, changes it in
+    place, and returns it.
+    """
+    return [("markdown", commonmarkdown), ("date", stamp_date)]
+
+
+def run_pipeline(msg, *, stages=None, timings=None):
+    """
+    Run ``msg`` through ``stages``, the ``outgoing_pipeline`` by default,
+    timing each one in ``timings`` if given.
+    """
+    for name, stage in stages or outgoing_pipeline():
+        with _timed(timings, name):
+            msg = stage(msg)
+    return msg
+
+
+class StageTimings:
+    """
+    Adds up the time spent in each stage of sending - parsing, each step
+    of the pipeline, generating the bytes, and delivering them - for
+    ``send --timings``. It can be shared between threads.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, elapsed):
+        with self._lock:
+            count, total = self.stages.get(name, (0, 0.0))
+            self.stages[name] = (count + 1, total + elapsed)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def report(self):
+        """
+        Return the lines of a table of the count, total, and average time
+        of each stage, in the order they first ran.
+        """
+        lines = [f"{'Stage':<12}{'Count':>8}{'Total':>13}{'Average':>13}\n"]
+        for name, (count, total) in self.stages.items():
+            lines.append(
+                f"{name:<12}{count:>8}{total * 1000:>10.1f} ms"
+                f"{total / count * 1000:>10.1f} ms\n"
+            )
+        return lines
+
+
+def _timed(timings, name):
+    if timings is None:
+        return contextlib.nullcontext()
+    return timings.stage(name)
+
+
+def _timed_iter(iterable, timings, name):
+    """
+    Yield from ``iterable``, timing how long each item takes to make as
+    ``name`` in ``timings``.
+    """
+    if timings is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        timings.add(name, time.perf_counter() - start)
+        yield item
 
 
 def replyify(*, msg, sender, reply_all=False, keep_attachments=False):
@@ -477,9 +872,48 @@ def get_sender(*, msg, config):
     return sender
 
 
-def send_message(
+def smtp_settings(config):
+    """
+    Return the SMTP connection settings from ``config``, as keyword
+    arguments for ``send_message``.
+    """
+    return dict(
+        smtp_host=config.get("SMTP_HOST", "localhost"),
+        smtp_port=config.get("SMTP_PORT", 25),
+        use_tls=config.get("SMTP_USE_TLS", False),
+        use_smtps=config.get("SMTP_USE_SMTPS", False),
+        username=config.get("SMTP_USERNAME", False),
+        password=config.get("SMTP_PASSWORD", False),
+    )
+
+
+def smtp_ssl_context():
+    """
+    Return the SSL context for SMTPS and STARTTLS, for both the blocking
+    and the asyncio engine. Like ``smtplib``'s own default, it doesn't
+    verify the server's certificate.
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+def _delivery_error(msg, error):
+    """
+    Return the ``WEmailDeliveryError`` for ``msg`` failing to deliver
+    with ``error``, an ``SMTPResponseException`` - the server turned down
+    the sender or the message.
+    """
+    delivery_error = WEmailDeliveryError(
+        f"Failed to deliver {subjectify(msg=msg)!r} - {error.smtp_error.decode()!r}"
+    )
+    delivery_error.__cause__ = error
+    return delivery_error
+
+
+def smtp_connect(
     *,
-    msg,
     smtp_host="localhost",
     smtp_port=25,
     use_tls=False,
@@ -487,335 +921,2330 @@ def send_message(
     username=None,
     password=None,
 ):
-    sender = msg.get("From")
-    recipients = getaddresses(
-        chain(msg.get_all("To", []), msg.get_all("Cc", []), msg.get_all("Bcc", []))
-    )
-    if not msg.get("Date"):
-        msg["Date"] = format_datetime(datetime.now(timezone.utc))
-    SMTP = smtplib.SMTP_SSL if use_smtps else smtplib.SMTP
-    with SMTP(host=smtp_host, port=smtp_port) as smtp:
+    """
+    Return a new SMTP connection that's done STARTTLS and logged in, as
+    asked.
+    """
+    if use_smtps:
+        smtp = smtplib.SMTP_SSL(
+            host=smtp_host, port=smtp_port, context=smtp_ssl_context()
+        )
+    else:
+        smtp = smtplib.SMTP(host=smtp_host, port=smtp_port)
+    try:
         if use_tls:
-            smtp.starttls()
+            smtp.starttls(context=smtp_ssl_context())
         smtp.ehlo()
         if username or password:
             smtp.login(username, password)
-        try:
-            smtp.send_message(
-                msg, from_addr=sender, to_addrs=[addr for _, addr in recipients if addr]
-            )
-        except smtplib.SMTPDataError as e:
-            raise WEmailDeliveryError(
-                f"Failed to deliver {subjectify(msg=msg)!r} - {e.args[1].decode()!r}"
-            ) from e
+    except BaseException:
+        smtp.close()
+        raise
+    return smtp
 
 
-def _make_draftname(*, subject, timestamp=None):
-    timestamp = timestamp or datetime.now()
-    sanitized = "-".join(re.sub(r"[^A-Za-z]", " ", subject).split())
-    return f"{timestamp:%Y%m%d%H%M%S}-{sanitized}.eml"
+def _is_disconnect(error):
+    """
+    Return True if ``error`` means the connection is gone - it dropped, or
+    the server closed it with a 421 - rather than that the server refused
+    something. ``smtplib``'s errors are all OSErrors too, so only plain
+    socket errors count.
+    """
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(error, smtplib.SMTPResponseException):
+        return error.smtp_code == 421
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
+
+
+def _pool_key(settings):
+    return (
+        settings.get("smtp_host", "localhost"),
+        settings.get("smtp_port", 25),
+        settings.get("use_tls", False),
+        settings.get("use_smtps", False),
+        settings.get("username"),
+    )
 
 
-def create_draft(*, template, config):
+class RecipientBatches:
     """
-    Creates a draft email from the provided template
+    Split ``recipients`` into batches of at most ``batch_size``, to send
+    one transaction each. Report what each batch refused with
+    ``refused()``: anyone turned away with a 452 (too many recipients)
+    goes back in line for a later batch, and later batches shrink to what
+    the server took. Everyone else that was refused ends up in ``failed``.
     """
-    draft_dir = config.get("draft_dir", config["maildir"] / "drafts")
-    draft_dir.mkdir(parents=True, exist_ok=True)
 
-    msg = _parser.parsebytes(template.encode())
+    def __init__(self, recipients, *, batch_size=None):
+        self.pending = collections.deque(recipients)
+        self.batch_size = batch_size or len(self.pending) or 1
+        self.failed = {}
+
+    def __iter__(self):
+        while self.pending:
+            count = min(self.batch_size, len(self.pending))
+            yield [self.pending.popleft() for _ in range(count)]
+
+    def refused(self, batch, refused):
+        retry = [addr for addr in batch if refused.get(addr, (None,))[0] == 452]
+        if len(retry) == len(batch) and self.batch_size == 1:
+            # Not even one at a time - give up on them.
+            retry = []
+        elif retry:
+            self.batch_size = max(len(batch) - len(retry), len(batch) // 2, 1)
+        self.pending.extendleft(reversed(retry))
+        self.failed.update(
+            (addr, reply) for addr, reply in refused.items() if addr not in retry
+        )
 
-    f = draft_dir / _make_draftname(subject=(msg["subject"] or ""))
-    f.write_text(template)
-    return f
 
+class SMTPPool:
+    """
+    Keeps SMTP connections open and logged in, so that sending a run of
+    messages through the same server only costs one handshake. Connections
+    are shared by host, port, TLS mode, and username, and are RSET before
+    each reuse. Dead connections - dropped, or closed by the server with
+    a 421 - are replaced without bothering the caller.
+    """
 
-def ensure_maildirs_exist(*, maildir):
-    maildir = Path(maildir)
-    dirnames = ("new", "cur", "drafts", "outbox", "sent")
+    def __init__(self):
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
 
-    for dirname in dirnames:
-        (maildir / dirname).mkdir(parents=True, exist_ok=True)
+    def __enter__(self):
+        return self
 
+    def __exit__(self, *exc_info):
+        self.close()
 
-def get_templates(*, dirname):
-    path = Path(dirname)
-    templates = []
-    for f in path.iterdir():
+    def close(self):
+        with self._lock:
+            connections = [smtp for idle in self._idle.values() for smtp in idle]
+            self._idle.clear()
+        for smtp in connections:
+            try:
+                smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+    @contextlib.contextmanager
+    def connection(self, **settings):
+        """
+        Check out a ready to use connection for ``settings``, the keyword
+        arguments for ``smtp_connect``. It goes back in the pool after,
+        unless the connection died.
+        """
+        key = _pool_key(settings)
+        smtp = None
+        while smtp is None:
+            with self._lock:
+                if not self._idle[key]:
+                    break
+                smtp = self._idle[key].pop()
+            try:
+                if smtp.rset()[0] != 250:
+                    raise smtplib.SMTPServerDisconnected("RSET failed")
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+                smtp = None
+        if smtp is None:
+            smtp = smtp_connect(**settings)
         try:
-            templates.append(EmailTemplate(name=f.name, content=f.read_text()))
-        except Exception:
-            print(f"Failed to read template {f.name}")
-    return templates
+            yield smtp
+        except BaseException as e:
+            if _is_disconnect(e):
+                smtp.close()
+            else:
+                with self._lock:
+                    self._idle[key].append(smtp)
+            raise
+        with self._lock:
+            self._idle[key].append(smtp)
 
+    def sendmail(self, envelope, *, batch_size=None, **settings):
+        """
+        Send ``envelope`` via a pooled connection for ``settings``, with
+        at most ``batch_size`` recipients per transaction. Its tail, if
+        any, is streamed into DATA after its data. Return a dict of the
+        recipients that were refused, like ``smtplib`` does.
+        """
+        if not envelope.to_addrs:
+            raise smtplib.SMTPRecipientsRefused({})
+        batches = RecipientBatches(envelope.to_addrs, batch_size=batch_size)
+        for batch in batches:
+            for attempt in range(2):
+                try:
+                    with self.connection(**settings) as smtp:
+                        try:
+                            if envelope.tail is None:
+                                refused = smtp.sendmail(
+                                    envelope.from_addr,
+                                    batch,
+                                    envelope.data,
+                                    _mail_options(smtp),
+                                )
+                            else:
+                                refused = _sendmail_tail(
+                                    smtp, envelope._replace(to_addrs=batch)
+                                )
+                        except smtplib.SMTPRecipientsRefused as e:
+                            refused = e.recipients
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    if attempt or not _is_disconnect(e):
+                        raise
+            batches.refused(batch, refused)
+        return batches.failed
 
-def reply(*, config, mailfile, reply_all=False, keep_attachments=False):
-    if mailfile.name.isdigit():
-        curmaildir = config["curdir"]
-        mailfile = sorted_mailfiles(maildir=curmaildir)[int(mailfile.name) - 1]
-    msg = _parser.parsebytes(mailfile.read_bytes())
-    msg = replyify(
-        msg=msg,
-        sender=get_sender(msg=msg, config=config),
-        reply_all=reply_all,
-        keep_attachments=keep_attachments,
+
+def send_message(
+    *,
+    msg,
+    smtp_host="localhost",
+    smtp_port=25,
+    use_tls=False,
+    use_smtps=False,
+    username=None,
+    password=None,
+    pool=None,
+    timings=None,
+    attachments=None,
+):
+    """
+    Send ``msg`` to all of its recipients. With an ``SMTPPool`` the
+    connection is borrowed from ``pool``, and the message is flattened
+    just the once, with ``timings`` of generating and delivering it.
+    Otherwise a new connection is made just for this message.
+    ``attachments`` spooled for ``msg`` by ``spool_attachments`` are
+    streamed in after it.
+    """
+    settings = dict(
+        smtp_host=smtp_host,
+        smtp_port=smtp_port,
+        use_tls=use_tls,
+        use_smtps=use_smtps,
+        username=username,
+        password=password,
     )
-    draft = create_draft(template=msg.as_string(), config=config)
-    subprocess.call([config["EDITOR"], draft])
-    choice = action_prompt()
-    if choice == "s":
-        send(config=config, mailfile=draft)
+    if pool is None and attachments is not None:
+        with SMTPPool() as pool:
+            return send_message(
+                msg=msg, pool=pool, timings=timings, attachments=attachments, **settings
+            )
+    try:
+        if pool is None:
+            stamp_date(msg)
+            with smtp_connect(**settings) as smtp:
+                smtp.send_message(msg, from_addr=msg.get("From"))
+        else:
+            with _timed(timings, "generate"):
+                envelope = with_attachments(make_envelope(msg), attachments)
+            with _timed(timings, "deliver"):
+                refused = pool.sendmail(envelope, **settings)
+            if refused and set(refused) >= set(envelope.to_addrs):
+                raise smtplib.SMTPRecipientsRefused(refused)
+    except smtplib.SMTPResponseException as e:
+        raise _delivery_error(msg, e) from e
 
 
-def save(*, config, maildir, mailnumber, target_folder):
-    try:
-        target_folder = config["maildir"] / target_folder
-        mailfile = sorted_mailfiles(maildir=maildir)[abs(int(mailnumber)) - 1]
-        with mailfile.open("rb") as f:
-            headers = _header_parser.parse(f)
-        newfile = target_folder / mailfile.name
-        target_folder.mkdir(parents=True, exist_ok=True)
-        mailfile.rename(newfile)
-        print(
-            f'Moved message from {headers["from"]} - {headers["subject"]!r}'
-            f" to {target_folder.name}."
-        )
-    except (FileNotFoundError, IndexError):
-        print(f"No mail found with number {mailnumber}")
+def iter_data(chunks):
+    """
+    Yield ``chunks`` of a message ready for DATA - CRLF line endings, and
+    leading dots doubled - ending with a line break. Lines can be split
+    across chunks any which way.
+    """
+    line_start = True
+    pending_cr = False
+    for chunk in chunks:
+        if pending_cr and chunk.startswith(b"\n"):
+            # The CR that ended the last chunk already made this CRLF.
+            chunk = chunk[1:]
+        pending_cr = chunk.endswith(b"\r")
+        chunk = re.sub(rb"\r\n|\r|\n", b"\r\n", chunk)
+        chunk = chunk.replace(b"\n.", b"\n..")
+        if line_start and chunk.startswith(b"."):
+            chunk = b"." + chunk
+        if chunk:
+            line_start = chunk.endswith(b"\n")
+            yield chunk
+    if not line_start:
+        yield b"\r\n"
+
+
+def iter_file(f, *, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Yield the contents of binary file ``f`` from the start, a chunk at a
+    time. It seeks before every read, so that any number of readers can
+    take turns with the same file.
+    """
+    position = 0
+    while True:
+        f.seek(position)
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return
+        position += len(chunk)
+        yield chunk
 
 
-def save_attachment(*, config, mailnumber, part, name, nozip=False, force=False):
-    mailfile = sorted_mailfiles(maildir=config["curdir"])[abs(int(mailnumber)) - 1]
-    with mailfile.open("rb") as f:
-        msg = _parser.parse(f)
-        for i, msgpart in enumerate(
-            (p for p in msg.walk() if not p.is_multipart()), start=1
-        ):
-            if i == part:
-                # TODO: It's possible that someone could do a path traversal attack here, I think -W. Werner, 2020-04-03
-                fname = msgpart.get_filename()
-                target = Path(name or "", fname)
-                if msgpart.get_content_maintype() == "text":
-                    target.write_text(msgpart.get_content())
-                else:
-                    target.write_bytes(msgpart.get_content())
+def _mail_options(smtp):
+    """
+    Return the MAIL options for ``smtp`` - ``BODY=8BITMIME`` if the server
+    has it, the same as ``AsyncSMTP.sendmail`` uses.
+    """
+    smtp.ehlo_or_helo_if_needed()
+    return ["BODY=8BITMIME"] if smtp.has_extn("8bitmime") else []
 
 
-def remove(*, config, maildir, mailnumber):
-    save(
-        config=config,
-        maildir=maildir,
-        mailnumber=mailnumber,
-        target_folder=config["maildir"] / "trash",
+def _sendmail_tail(smtp, envelope):
+    """
+    Like ``smtplib.SMTP.sendmail``, but for an ``envelope`` with a tail,
+    which is streamed into DATA without ever being read in whole.
+    """
+    from_addr, to_addrs, data, tail = envelope
+    code, message = smtp.mail(from_addr, _mail_options(smtp))
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, message, from_addr)
+    refused = {}
+    for addr in to_addrs:
+        code, message = smtp.rcpt(addr)
+        if code not in (250, 251):
+            refused[addr] = (code, message)
+        if code == 421:
+            smtp.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(to_addrs):
+        smtp.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+    smtp.putcmd("data")
+    code, message = smtp.getreply()
+    if code != 354:
+        smtp.rset()
+        raise smtplib.SMTPDataError(code, message)
+    try:
+        for chunk in iter_data(chain([data], iter_file(tail))):
+            smtp.send(chunk)
+        smtp.send(b".\r\n")
+    except BaseException:
+        # Part way through DATA, the connection can't be used again.
+        smtp.close()
+        raise
+    code, message = smtp.getreply()
+    if code != 250:
+        if code == 421:
+            smtp.close()
+        else:
+            smtp.rset()
+        raise smtplib.SMTPDataError(code, message)
+    return refused
+
+
+def can_send_raw(headers):
+    """
+    Return True if the message with ``headers`` can be sent exactly as it
+    was written, without parsing the rest of it - it needs none of the
+    ``OUTGOING_TRANSFORM_HEADERS`` rewriting, and its headers are plain
+    ASCII.
+    """
+    return not any(name in headers for name in OUTGOING_TRANSFORM_HEADERS) and all(
+        str(value).isascii() for value in headers.values()
     )
-    # TODO: empty old trash messages -W. Werner, 2020-01-03
 
 
-def check_email(config):
-    maildir = config["maildir"]
-    curdir = maildir / "cur"
+def send_raw(
+    *,
+    mailfile,
+    headers,
+    smtp_host="localhost",
+    smtp_port=25,
+    use_tls=False,
+    use_smtps=False,
+    username=None,
+    password=None,
+    pool=None,
+    timings=None,
+):
+    """
+    Send ``mailfile``, with the already parsed ``headers``, straight from
+    the file - see ``can_send_raw``. Only a missing Date is added.
+    """
+    settings = dict(
+        smtp_host=smtp_host,
+        smtp_port=smtp_port,
+        use_tls=use_tls,
+        use_smtps=use_smtps,
+        username=username,
+        password=password,
+    )
+    if pool is None:
+        with SMTPPool() as pool:
+            return send_raw(
+                mailfile=mailfile,
+                headers=headers,
+                pool=pool,
+                timings=timings,
+                **settings,
+            )
+    prefix = b""
+    if not headers.get("Date"):
+        prefix = f"Date: {format_datetime(datetime.now(timezone.utc))}\r\n".encode()
+    recipients = getaddresses(
+        chain(headers.get_all("To", []), headers.get_all("Cc", []))
+    )
+    to_addrs = [addr for _, addr in recipients if addr]
+    try:
+        with _timed(timings, "deliver"), open(mailfile, "rb") as f:
+            refused = pool.sendmail(
+                Envelope(parseaddr(headers.get("From", ""))[1], to_addrs, prefix, f),
+                **settings,
+            )
+        if refused and set(refused) >= set(to_addrs):
+            raise smtplib.SMTPRecipientsRefused(refused)
+    except smtplib.SMTPResponseException as e:
+        raise _delivery_error(headers, e) from e
+
+
+def make_envelope(msg):
+    """
+    Return the ``Envelope`` for sending ``msg`` - the sender and every
+    recipient, plus the message flattened for the wire. Like
+    ``smtplib.SMTP.send_message``, a missing Date is filled in and Bcc
+    is left out of the data.
+    """
+    stamp_date(msg)
+    recipients = getaddresses(
+        chain(msg.get_all("To", []), msg.get_all("Cc", []), msg.get_all("Bcc", []))
+    )
+    msg_copy = copy.copy(msg)
+    del msg_copy["Bcc"]
+    del msg_copy["Resent-Bcc"]
+    with io.BytesIO() as f:
+        BytesGenerator(f, policy=msg.policy.clone(linesep="\r\n")).flatten(
+            msg_copy, linesep="\r\n"
+        )
+        data = f.getvalue()
+    return Envelope(
+        from_addr=parseaddr(msg.get("From", ""))[1],
+        to_addrs=[addr for _, addr in recipients if addr],
+        data=data,
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _local_hostname():
+    return socket.getfqdn()
+
+
+class AsyncSMTP:
+    """
+    Just enough of an SMTP client, on asyncio streams, to send mail:
+    SMTPS or STARTTLS, AUTH PLAIN or LOGIN, and PIPELINING when the
+    server has it. Errors are the same ``smtplib`` exceptions that
+    ``smtplib.SMTP`` raises.
+    """
+
+    def __init__(
+        self,
+        *,
+        smtp_host="localhost",
+        smtp_port=25,
+        use_tls=False,
+        use_smtps=False,
+        username=None,
+        password=None,
+    ):
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.use_tls = use_tls
+        self.use_smtps = use_smtps
+        self.username = username
+        self.password = password
+        self.reader = self.writer = None
+        self.extensions = {}
+
+    async def connect(self):
+        """
+        Connect, and STARTTLS and log in as needed.
+        """
+        context = smtp_ssl_context() if self.use_smtps else None
+        self.reader, self.writer = await asyncio.open_connection(
+            self.smtp_host, self.smtp_port, ssl=context
+        )
+        try:
+            code, message = await self.reply()
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, message)
+            await self.ehlo()
+            if self.use_tls:
+                await self.starttls()
+                await self.ehlo()
+            if self.username or self.password:
+                await self.login()
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def reply(self):
+        """
+        Read a (possibly multiline) reply, and return ``(code, message)``.
+        """
+        if self.reader is None:
+            raise smtplib.SMTPServerDisconnected("Not connected")
+        lines = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                self.close()
+                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+            lines.append(line[4:].strip())
+            if line[3:4] != b"-":
+                break
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        if code == 421:
+            self.close()
+        return code, b"\n".join(lines)
+
+    async def command(self, line):
+        if self.writer is None:
+            raise smtplib.SMTPServerDisconnected("Not connected")
+        self.writer.write(line.encode() + b"\r\n")
+        await self.writer.drain()
+        return await self.reply()
+
+    async def ehlo(self):
+        code, message = await self.command(f"EHLO {_local_hostname()}")
+        if code != 250:
+            code, message = await self.command(f"HELO {_local_hostname()}")
+            if code != 250:
+                raise smtplib.SMTPHeloError(code, message)
+        self.extensions = {}
+        for line in message.decode("ascii", "replace").splitlines()[1:]:
+            name, _, params = line.partition(" ")
+            self.extensions[name.upper()] = params
+
+    async def starttls(self):
+        if "STARTTLS" not in self.extensions:
+            raise smtplib.SMTPNotSupportedError("Server does not support STARTTLS")
+        code, message = await self.command("STARTTLS")
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, message)
+        context = smtp_ssl_context()
+        if hasattr(self.writer, "start_tls"):
+            # Python 3.11+
+            await self.writer.start_tls(context, server_hostname=self.smtp_host)
+        else:
+            loop = asyncio.get_running_loop()
+            protocol = self.writer.transport.get_protocol()
+            transport = await loop.start_tls(
+                self.writer.transport,
+                protocol,
+                context,
+                server_hostname=self.smtp_host,
+            )
+            self.writer = asyncio.StreamWriter(transport, protocol, self.reader, loop)
+
+    async def login(self):
+        mechanisms = self.extensions.get("AUTH", "").upper().split()
+        username = (self.username or "").encode()
+        password = (self.password or "").encode()
+        if "PLAIN" in mechanisms:
+            token = base64.b64encode(b"\0" + username + b"\0" + password)
+            code, message = await self.command(f"AUTH PLAIN {token.decode()}")
+        elif "LOGIN" in mechanisms:
+            code, message = await self.command("AUTH LOGIN")
+            for secret in (username, password):
+                if code != 334:
+                    break
+                code, message = await self.command(base64.b64encode(secret).decode())
+        else:
+            raise smtplib.SMTPNotSupportedError(
+                "No suitable authentication method found."
+            )
+        if code not in (235, 503):
+            raise smtplib.SMTPAuthenticationError(code, message)
+
+    async def rset(self):
+        return await self.command("RSET")
+
+    async def quit(self):
+        try:
+            await self.command("QUIT")
+        finally:
+            self.close()
+
+    async def sendmail(self, from_addr, to_addrs, data, tail=None):
+        """
+        Send ``data``, and then binary file ``tail`` if given, from
+        ``from_addr`` to ``to_addrs``, returning a dict of any refused
+        recipients like ``smtplib.SMTP.sendmail`` does.
+        """
+        mail = f"MAIL FROM:<{from_addr}>"
+        if "8BITMIME" in self.extensions:
+            mail += " BODY=8BITMIME"
+        commands = [mail]
+        commands.extend(f"RCPT TO:<{addr}>" for addr in to_addrs)
+        commands.append("DATA")
+        if "PIPELINING" in self.extensions:
+            self.writer.write("".join(c + "\r\n" for c in commands).encode())
+            await self.writer.drain()
+            replies = [await self.reply() for _ in commands]
+        else:
+            replies = [await self.command(commands[0])]
+            if replies[0][0] == 250:
+                for command in commands[1:]:
+                    replies.append(await self.command(command))
+        (code, message), *rcpt_replies = replies
+        if code != 250:
+            if code != 421:
+                await self.rset()
+            raise smtplib.SMTPSenderRefused(code, message, from_addr)
+        data_code, data_message = rcpt_replies.pop()
+        refused = {
+            addr: reply
+            for addr, reply in zip(to_addrs, rcpt_replies)
+            if reply[0] not in (250, 251)
+        }
+        if len(refused) == len(to_addrs):
+            if data_code == 354:
+                # Pipelined DATA was accepted anyway - end it empty.
+                await self.command(".")
+            await self.rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+        if data_code != 354:
+            await self.rset()
+            raise smtplib.SMTPDataError(data_code, data_message)
+        chunks = [data] if tail is None else chain([data], iter_file(tail))
+        for chunk in iter_data(chunks):
+            self.writer.write(chunk)
+            await self.writer.drain()
+        self.writer.write(b".\r\n")
+        await self.writer.drain()
+        code, message = await self.reply()
+        if code != 250:
+            if code != 421:
+                await self.rset()
+            raise smtplib.SMTPDataError(code, message)
+        return refused
+
+
+class AsyncSMTPPool:
+    """
+    The asyncio counterpart of ``SMTPPool``. It also caps the number of
+    connections to each host at ``max_connections``, so any number of
+    deliveries can be in flight without swamping a server.
+    """
+
+    def __init__(self):
+        self._idle = collections.defaultdict(list)
+        self._limits = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        connections = [smtp for idle in self._idle.values() for smtp in idle]
+        self._idle.clear()
+        for smtp in connections:
+            try:
+                await smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                smtp.close()
+
+    @contextlib.asynccontextmanager
+    async def connection(self, *, max_connections=SMTP_MAX_CONNECTIONS, **settings):
+        key = _pool_key(settings)
+        if key[0] not in self._limits:
+            self._limits[key[0]] = asyncio.Semaphore(max_connections)
+        async with self._limits[key[0]]:
+            smtp = None
+            while smtp is None and self._idle[key]:
+                smtp = self._idle[key].pop()
+                try:
+                    if (await smtp.rset())[0] != 250:
+                        raise smtplib.SMTPServerDisconnected("RSET failed")
+                except (smtplib.SMTPException, OSError):
+                    smtp.close()
+                    smtp = None
+            if smtp is None:
+                smtp = AsyncSMTP(**settings)
+                await smtp.connect()
+            try:
+                yield smtp
+            except BaseException as e:
+                if _is_disconnect(e):
+                    smtp.close()
+                else:
+                    self._idle[key].append(smtp)
+                raise
+            self._idle[key].append(smtp)
+
+    async def sendmail(
+        self,
+        envelope,
+        *,
+        batch_size=None,
+        max_connections=SMTP_MAX_CONNECTIONS,
+        **settings,
+    ):
+        """
+        Send ``envelope`` via a pooled connection for ``settings``, with
+        at most ``batch_size`` recipients per transaction, retrying once
+        on a new connection if one drops. Return a dict of the refused
+        recipients.
+        """
+        if not envelope.to_addrs:
+            raise smtplib.SMTPRecipientsRefused({})
+        batches = RecipientBatches(envelope.to_addrs, batch_size=batch_size)
+        for batch in batches:
+            for attempt in range(2):
+                try:
+                    async with self.connection(
+                        max_connections=max_connections, **settings
+                    ) as smtp:
+                        try:
+                            refused = await smtp.sendmail(
+                                envelope.from_addr, batch, envelope.data, envelope.tail
+                            )
+                        except smtplib.SMTPRecipientsRefused as e:
+                            refused = e.recipients
+                    break
+                except (smtplib.SMTPException, OSError) as e:
+                    if attempt or not _is_disconnect(e):
+                        raise
+            batches.refused(batch, refused)
+        return batches.failed
+
+
+def _make_draftname(*, subject, timestamp=None):
+    timestamp = timestamp or datetime.now()
+    sanitized = "-".join(re.sub(r"[^A-Za-z]", " ", subject).split())
+    return f"{timestamp:%Y%m%d%H%M%S}-{sanitized}.eml"
+
+
+def create_draft(*, template, config):
+    """
+    Creates a draft email from the provided template
+    """
+    draft_dir = config.get("draft_dir", config["maildir"] / "drafts")
+    draft_dir.mkdir(parents=True, exist_ok=True)
+
+    msg = _parser.parsebytes(template.encode())
+
+    f = draft_dir / _make_draftname(subject=(msg["subject"] or ""))
+    f.write_text(template)
+    return f
+
+
+def ensure_maildirs_exist(*, maildir):
+    maildir = Path(maildir)
+    dirnames = ("new", "cur", "drafts", "outbox", "sent")
+
+    for dirname in dirnames:
+        (maildir / dirname).mkdir(parents=True, exist_ok=True)
+
+
+def get_templates(*, dirname):
+    path = Path(dirname)
+    templates = []
+    for f in path.iterdir():
+        try:
+            templates.append(EmailTemplate(name=f.name, content=f.read_text()))
+        except Exception:
+            print(f"Failed to read template {f.name}")
+    return templates
+
+
+def reply(*, config, mailfile, reply_all=False, keep_attachments=False):
+    if mailfile.name.isdigit() or (
+        is_short_id(mailfile.name) and not mailfile.exists()
+    ):
+        mailfile = resolve_mailfile(maildir=config["curdir"], mailnumber=mailfile.name)
+    msg = _parser.parsebytes(mailfile.read_bytes())
+    msg = replyify(
+        msg=msg,
+        sender=get_sender(msg=msg, config=config),
+        reply_all=reply_all,
+        keep_attachments=keep_attachments,
+    )
+    draft = create_draft(template=msg.as_string(), config=config)
+    subprocess.call([config["EDITOR"], draft])
+    choice = action_prompt()
+    if choice == "s":
+        send(config=config, mailfile=draft)
+
+
+def save(*, config, maildir, mailnumber, target_folder):
+    try:
+        target_folder = config["maildir"] / target_folder
+        mailfile = resolve_mailfile(maildir=maildir, mailnumber=mailnumber)
+        headers = get_headers(mailfile)
+        newfile = target_folder / mailfile.name
+        target_folder.mkdir(parents=True, exist_ok=True)
+        mailfile.rename(newfile)
+        print(
+            f'Moved message from {headers["from"]} - {headers["subject"]!r}'
+            f" to {target_folder.name}."
+        )
+    except (FileNotFoundError, IndexError):
+        print(f"No mail found with number {mailnumber}")
+
+
+def save_part(data, part, target):
+    """
+    Decode ``part`` of ``data`` into the file ``target`` a chunk at a
+    time, so even a huge attachment never has to fit in memory. Text
+    parts are decoded from their charset and written as text.
+    """
+    chunks = iter_decoded(data, part)
+    if part.content_type.startswith("text/"):
+        with open(target, "w") as f:
+            for text in iter_text(chunks, charset=part.charset):
+                f.write(text)
+    else:
+        with open(target, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+
+def _spool_part(data, part):
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    for chunk in iter_decoded(data, part):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
+
+
+def _map_ahead(executor, fn, items, *, ahead):
+    """
+    Like ``executor.map``, but only ``ahead`` items are ever submitted
+    before their results have been taken, rather than every item at once.
+    """
+    pending = collections.deque()
+    for item in items:
+        if len(pending) >= ahead:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, item))
+    while pending:
+        yield pending.popleft().result()
+
+
+def safe_filename(filename, *, default):
+    """
+    Return just the last component of an attachment's ``filename``, so
+    that saving it can't escape the target directory, or ``default`` if
+    that leaves nothing usable.
+    """
+    fname = Path(filename or "").name
+    if fname in ("", ".", ".."):
+        return default
+    return fname
+
+
+def _attachment_names(parts):
+    """
+    Yield a safe filename for each of the numbered ``parts``, prefixing
+    any repeats with their part number so nothing gets overwritten.
+    """
+    seen = set()
+    for i, part in parts:
+        fname = safe_filename(part.filename, default=f"part-{i}")
+        if fname in seen:
+            fname = f"{i}-{fname}"
+        seen.add(fname)
+        yield fname
+
+
+def _confirm_overwrite(target, *, force):
+    if force or not target.exists():
+        return True
+    choice = input(f"{target} exists. Overwrite? [y/N]: ")
+    return choice.lower().strip() in ("y", "yes", "ja", "si", "oui")
+
+
+def save_all_attachments(*, data, parts, name, nozip=False, force=False):
+    """
+    Save every one of the ``(number, part)`` pairs in ``parts`` into a
+    zipfile, or into the ``name`` directory if ``nozip`` is set. Parts
+    are decoded on a thread pool. For a zipfile each one is compressed
+    into the archive as soon as it's ready, while the next ``DECODE_JOBS``
+    parts are decoding - no more, so that only those few are ever spooled
+    to disk at once.
+    """
+    names = list(_attachment_names(parts))
+    parts = [part for _, part in parts]
+    if nozip:
+        directory = Path(name or "")
+        jobs = [
+            (part, directory / fname)
+            for part, fname in zip(parts, names)
+            if _confirm_overwrite(directory / fname, force=force)
+        ]
+        with ThreadPoolExecutor(max_workers=DECODE_JOBS) as pool:
+            # list() so that any errors get raised here.
+            list(pool.map(lambda job: save_part(data, *job), jobs))
+        print(f"Saved {len(jobs)} attachments to {directory}")
+        return
+
+    target = Path(name or "")
+    if target.is_dir():
+        target /= "attachments.zip"
+    if not _confirm_overwrite(target, force=force):
+        return
+    with ThreadPoolExecutor(max_workers=DECODE_JOBS) as pool, zipfile.ZipFile(
+        target, "w", compression=zipfile.ZIP_DEFLATED
+    ) as archive:
+        spools = _map_ahead(
+            pool, functools.partial(_spool_part, data), parts, ahead=DECODE_JOBS
+        )
+        for fname, spool in zip(names, spools):
+            size = spool.seek(0, os.SEEK_END)
+            spool.seek(0)
+            zip64 = size >= zipfile.ZIP64_LIMIT
+            with spool, archive.open(fname, "w", force_zip64=zip64) as dest:
+                shutil.copyfileobj(spool, dest)
+    print(f"Saved {len(names)} attachments to {target}")
+
+
+def save_attachment(*, config, mailnumber, part, name, nozip=False, force=False):
+    mailfile = resolve_mailfile(maildir=config["curdir"], mailnumber=mailnumber)
+    with map_mailfile(mailfile) as data:
+        if part == "all":
+            return save_all_attachments(
+                data=data,
+                parts=[
+                    (i, p)
+                    for i, p in enumerate(leaf_parts(mime_tree(data)), start=1)
+                    if p.filename
+                ],
+                name=name,
+                nozip=nozip,
+                force=force,
+            )
+        for i, msgpart in enumerate(leaf_parts(mime_tree(data)), start=1):
+            if i == part:
+                fname = safe_filename(msgpart.filename, default=f"part-{i}")
+                target = Path(name or "", fname)
+                save_part(data, msgpart, target)
+
+
+def remove(*, config, maildir, mailnumber):
+    save(
+        config=config,
+        maildir=maildir,
+        mailnumber=mailnumber,
+        target_folder=config["maildir"] / "trash",
+    )
+    # TODO: empty old trash messages -W. Werner, 2020-01-03
+
+
+def check_email(config):
+    maildir = config["maildir"]
+    curdir = maildir / "cur"
     newdir = maildir / "new"
     count = 0
-    for file in newdir.iterdir():
+    for entry in scan_maildir(newdir):
         count += 1
-        nextpath = curdir / file.name
-        file.rename(nextpath)
+        os.rename(entry.path, curdir / entry.name)
     print(f'{count} new message{"s" if count != 1 else ""}.')
 
 
-def do_new(config, template_number=None):
-    maildir = config["maildir"]
-    template_dir = maildir / "templates"
-    templates = get_templates(dirname=template_dir)
-    if not templates:
-        print(f"No templates. Add some to {template_dir} and try again")
-        return
-    for i, template in enumerate(templates, start=1):
-        print(f"{i}. {template.name}")
-    done = False
-    while not done:
-        choice = template_number or input(
-            f"Which template? [1-{len(templates)} (^C quits)]: "
-        )
-        # If cli passed template number, and it was bad, we want to
-        # avoid an infinite loop!
-        template_number = None
+def do_new(config, template_number=None):
+    maildir = config["maildir"]
+    template_dir = maildir / "templates"
+    templates = get_templates(dirname=template_dir)
+    if not templates:
+        print(f"No templates. Add some to {template_dir} and try again")
+        return
+    for i, template in enumerate(templates, start=1):
+        print(f"{i}. {template.name}")
+    done = False
+    while not done:
+        choice = template_number or input(
+            f"Which template? [1-{len(templates)} (^C quits)]: "
+        )
+        # If cli passed template number, and it was bad, we want to
+        # avoid an infinite loop!
+        template_number = None
+        try:
+            template = templates[int(choice) - 1]
+        except (IndexError, ValueError):
+            print(f"Invalid choice {choice!r}")
+        else:
+            done = True
+    draft = create_draft(template=template.content, config=config)
+    subprocess.call([config["EDITOR"], draft])
+    choice = action_prompt()
+    if choice == "s":
+        print("^C to cancel sending")
+        timer = config.get("ABORT_TIMEOUT", 5)
+        for sec in range(timer):
+            try:
+                print(f"\rSending in {timer-sec}...[0K", end="")
+                sys.stdout.flush()
+                time.sleep(1)
+            except KeyboardInterrupt:
+                print("\r^C caught, draft saved.[0K")
+                break
+        else:
+            print("\rSending now...[0K")
+            stage_name = draft.parent.parent / "outbox" / draft.name
+            draft.rename(stage_name)
+            send(config=config, mailfile=stage_name)
+            staged_email_count = sum(1 for _ in scan_maildir(maildir / "outbox"))
+            if staged_email_count:
+                print(
+                    f"{staged_email_count} emails to send. Run `{sys.argv[0]} send_all` to send."
+                )
+    elif choice == "q":
+        stage_name = draft.parent.parent / "outbox" / draft.name
+        draft.rename(stage_name)
+        print(f"Email queued as {stage_name}")
+    elif choice == "v":
+        with draft.open("rb") as f:
+            headers = parse_headers(f)
+        subject = subjectify(msg=headers)
+        new_name = draft.parent / _make_draftname(subject=subject)
+        draft.rename(new_name)
+        print(f"Draft saved as {new_name}")
+    elif choice == "d":
+        choice = input("Really delete draft? Cannot be undone! [y/N]: ")
+        if choice.lower() in ("y", "yes", "ja", "si", "oui"):
+            draft.unlink()
+
+
+def send_all(*, config, jobs=1, use_async=False, timings=None):
+    """
+    Send everything in the outbox. With ``jobs`` > 1, that many messages
+    are sent at once, but no more than ``SMTP_MAX_CONNECTIONS`` (from the
+    sending account's config) to any one server. ``use_async`` sends
+    everything at once on the asyncio engine instead, with the same
+    limit. A failed message stays in the outbox and the rest still get
+    sent - whatever goes wrong with one message is reported against it.
+    Stages are timed in ``timings`` across all the messages, if
+    given.
+    """
+    maildir = config["maildir"]
+    outbox = maildir / "outbox"
+    to_send = [Path(entry.path) for entry in scan_maildir(outbox)]
+    if not to_send:
+        print("Nothing to send.")
+        return
+    print("Going to send...")
+    for mailfile in to_send:
+        print(mailfile)
+    choice = input("Really send all? [Y/n]: ")
+    if choice.lower().strip() not in ("", "y", "yes", "si", "oui", "ja"):
+        print("Aborted!")
+        return
+
+    if use_async:
+        errors = send_async(
+            config=config, mailfiles=to_send, interactive=False, timings=timings
+        )
+        _report_sent(to_send, errors, outbox=outbox)
+        return
+
+    host_limits = {}
+    host_limits_lock = threading.Lock()
+
+    def host_limit(mailfile):
+        account = account_config(config, get_headers(mailfile))
+        host = account.get("SMTP_HOST", "localhost")
+        with host_limits_lock:
+            if host not in host_limits:
+                host_limits[host] = threading.BoundedSemaphore(
+                    account.get("SMTP_MAX_CONNECTIONS", SMTP_MAX_CONNECTIONS)
+                )
+            return host_limits[host]
+
+    def deliver(mailfile):
+        try:
+            with host_limit(mailfile):
+                sent = send(
+                    config=config,
+                    mailfile=mailfile,
+                    pool=pool,
+                    interactive=jobs <= 1,
+                    timings=timings,
+                )
+        except Exception as e:
+            return e
+        return None if sent else SKIPPED
+
+    with SMTPPool() as pool:
+        if jobs > 1:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                errors = list(executor.map(deliver, to_send))
+        else:
+            errors = [deliver(mailfile) for mailfile in to_send]
+    _report_sent(to_send, errors, outbox=outbox)
+
+
+def _report_sent(mailfiles, errors, *, outbox):
+    for mailfile, error in zip(mailfiles, errors):
+        if error is None:
+            print(f"OK     {mailfile.name}")
+        elif error is SKIPPED:
+            print(f"SKIP   {mailfile.name}")
+        else:
+            print(f"FAILED {mailfile.name} - {error}")
+    skipped = sum(error is SKIPPED for error in errors)
+    failed = sum(error is not None for error in errors) - skipped
+    if skipped:
+        print(f"{skipped} of {len(mailfiles)} skipped, left in {outbox}")
+    if failed:
+        print(f"{failed} of {len(mailfiles)} failed, left in {outbox}")
+    print("Done!")
+
+
+def account_config(config, msg):
+    """
+    Return ``config`` with the settings for the account that ``msg`` is
+    from, if there are any, taking priority.
+    """
+    from_addr = parseaddr(msg["from"] or "")[1]
+    config = config.copy()
+    if from_addr in config:
+        config.update(config[from_addr])
+    return config
+
+
+_sent_lock = threading.Lock()
+
+
+def move_to_sent(mailfile, sentfile):
+    """
+    Move ``mailfile`` to ``sentfile``, numbering it if there's already a
+    message there - say, one with the same subject sent the same second.
+    """
+    with _sent_lock:
+        sentfile.parent.mkdir(parents=True, exist_ok=True)
+        target = sentfile
+        count = 1
+        while target.exists():
+            count += 1
+            target = sentfile.with_name(f"{sentfile.stem}-{count}{sentfile.suffix}")
+        mailfile.rename(target)
+    return target
+
+
+def sent_path(config, msg):
+    """
+    Return where ``msg`` goes in the sent folder, once it's been sent.
+    """
+    return config["maildir"] / "sent" / f"{prettynow()}-{subjectify(msg=msg)}.eml"
+
+
+def prepare_send(*, config, mailfile, interactive=True, timings=None):
+    """
+    Read ``mailfile`` and get it ready to send, returning an ``Outgoing``
+    with the sending account's config, the message, the mailing list
+    recipients (or None, for a regular message), and where the message
+    goes once it's sent, plus its ``spool_attachments``. Returns None if
+    sending to a mailing list was aborted.
+
+    The draft is parsed once, then run through the ``outgoing_pipeline``,
+    with each stage timed in ``timings`` if given.
+    """
+    with _timed(timings, "parse"):
+        msg = _parser.parsebytes(mailfile.read_bytes())
+    sentfile = sent_path(config, msg)
+    config = account_config(config, msg)
+    msg = run_pipeline(msg, timings=timings)
+    recipients = None
+    mailing_list = msg.get("X-MailingList")
+    if mailing_list:
+        recipients = [
+            r for r in config.get("mailing_list", {}).get(mailing_list) if r.strip()
+        ]
+        # Check the mode now, rather than part way through sending.
+        mailing_list_mode(config)
+        if interactive:
+            choice = input(f"Sending to {len(recipients)}, continue? [Y/n]: ")
+            if choice.lower().strip() in ("n", "no"):
+                print("Aborted")
+                return None
+    with _timed(timings, "attachments"):
+        attachments = spool_attachments(msg)
+    return Outgoing(
+        config=config,
+        msg=msg,
+        recipients=recipients,
+        sentfile=sentfile,
+        attachments=attachments,
+    )
+
+
+def address_to(msg, recipient):
+    """
+    Make ``recipient`` the only recipient of ``msg``.
+    """
+    for field in ("to", "cc", "bcc"):
+        try:
+            del msg[field]
+        except KeyError:
+            pass
+    msg["To"] = recipient
+
+
+def mailing_list_mode(config):
+    """
+    Return how mailing lists are sent - ``each`` recipient gets their own
+    message, ``bulk`` sends one message to batches of
+    ``MAILING_LIST_BATCH_SIZE`` recipients, who only appear in the
+    envelope, and ``merge`` gives each recipient their own message with
+    ``{{to}}``, ``{{name}}``, and ``{{email}}`` filled in.
+    """
+    mode = config.get("MAILING_LIST_MODE", "each")
+    if mode not in MAILING_LIST_MODES:
+        raise WEmailError(
+            f"Unknown MAILING_LIST_MODE {mode!r}, expected one of {MAILING_LIST_MODES}"
+        )
+    return mode
+
+
+def iter_envelopes(outgoing):
+    """
+    Yield the ``Envelope`` for each delivery of ``outgoing`` - one for a
+    regular message or a ``bulk`` mailing list, or one per mailing list
+    recipient. Every one of them ends with the same spooled attachments.
+    """
+    for envelope in _iter_envelopes(outgoing):
+        yield with_attachments(envelope, outgoing.attachments)
+
+
+def _iter_envelopes(outgoing):
+    if outgoing.recipients is None:
+        yield make_envelope(outgoing.msg)
+        return
+    if mailing_list_mode(outgoing.config) == "bulk":
+        address_to(outgoing.msg, "undisclosed-recipients:;")
+        envelope = make_envelope(outgoing.msg)
+        recipients = getaddresses(outgoing.recipients)
+        yield envelope._replace(to_addrs=[addr for _, addr in recipients if addr])
+        return
+    if mailing_list_mode(outgoing.config) == "merge":
+        yield from iter_merged_envelopes(outgoing.msg, outgoing.recipients)
+        return
+    for recipient in outgoing.recipients:
+        address_to(outgoing.msg, recipient)
+        yield make_envelope(outgoing.msg)
+
+
+def merge_values(recipient):
+    name, email = parseaddr(recipient)
+    return {"to": recipient, "name": name or email, "email": email}
+
+
+def _merge_parts(msg):
+    """
+    Yield the parts of ``msg`` that merge fields are filled in - the text
+    parts that aren't attachments.
+    """
+    for part in msg.walk():
+        if (
+            part.get_content_maintype() == "text"
+            and part.get_content_disposition() != "attachment"
+        ):
+            yield part
+
+
+def merge_template(msg, *, slot):
+    """
+    Flatten ``msg``, addressed to ``slot``, into a template for a mail
+    merge: a list of literal bytes with the names of the merge fields
+    between them, ready for ``merge``. The ``slot`` address is swapped
+    for a ``{{to}}`` field.
+
+    Returns None if the fields can't be spliced into the flattened bytes
+    safely - say, because a part is base64 or quoted-printable encoded,
+    or isn't UTF-8, or a header with a field in it is RFC 2047 encoded.
+    """
+    expected = len(_MERGE_FIELD.findall(msg.get("Subject", "")))
+    for part in _merge_parts(msg):
+        if part.get("content-transfer-encoding", "7bit").lower() not in (
+            "7bit",
+            "8bit",
+        ) or part.get_content_charset("us-ascii") not in ("us-ascii", "utf-8"):
+            return None
+        expected += len(_MERGE_FIELD.findall(part.get_content()))
+    address_to(msg, slot)
+    data = make_envelope(msg).data
+    if data.count(slot.encode()) != 1:
+        return None
+    if len(_MERGE_FIELD_BYTES.findall(data)) != expected:
+        return None
+    header_end = _HEADER_END.search(data)
+    for match in _HEADER_FIELD_BYTES.finditer(data, 0, header_end.start()):
+        field = match[0]
+        if _MERGE_FIELD_BYTES.search(field) and _ENCODED_WORD_BYTES.search(field):
+            # Splicing into an encoded-word would break it.
+            return None
+    return _MERGE_FIELD_BYTES.split(data.replace(slot.encode(), b"{{to}}"))
+
+
+def merge(template, values):
+    """
+    Return the message bytes from ``template`` with the merge ``values``
+    filled in.
+    """
+    return b"".join(
+        values[chunk.decode()].encode() if i % 2 else chunk
+        for i, chunk in enumerate(template)
+    )
+
+
+def iter_merged_envelopes(msg, recipients):
+    """
+    Yield an ``Envelope`` for each of ``recipients``, with its merge
+    fields filled in. The message is only flattened once, and each
+    recipient's values are spliced into the bytes. If that isn't safe -
+    see ``merge_template`` - or a recipient has non-ASCII values, the
+    message is filled in and flattened again for them instead.
+    """
+    slot = f"merge-{os.urandom(8).hex()}@wemail.invalid"
+    subject = msg.get("Subject")
+    contents = [(part, part.get_content()) for part in _merge_parts(msg)]
+    template = merge_template(msg, slot=slot)
+    from_addr = parseaddr(msg.get("From", ""))[1]
+    for recipient in recipients:
+        values = merge_values(recipient)
+        to_addrs = [values["email"]]
+        if template is not None and all(v.isascii() for v in values.values()):
+            yield Envelope(from_addr, to_addrs, merge(template, values))
+            continue
+
+        def fill(text):
+            return _MERGE_FIELD.sub(lambda m: values[m.group(1)], text)
+
+        address_to(msg, recipient)
+        if subject is not None:
+            msg.replace_header("Subject", fill(subject))
+        for part, content in contents:
+            part.set_content(fill(content), subtype=part.get_content_subtype())
+        yield make_envelope(msg)._replace(to_addrs=to_addrs)
+
+
+def send(
+    *, config, mailfile, pool=None, interactive=True, use_async=False, timings=None
+):
+    """
+    Send ``mailfile`` and move it to the sent folder. Connections come
+    from ``pool`` if one is given, so that they can be reused across
+    calls - either way, a mailing list only connects once. If not
+    ``interactive``, there's no progress output and mailing lists are
+    sent without asking. ``use_async`` sends with the asyncio engine.
+
+    A draft that needs no rewriting - see ``can_send_raw`` - is sent
+    straight from the file without being parsed.
+
+    The time taken by each stage of sending is added to ``timings``, a
+    ``StageTimings``, if given.
+
+    Return True once the message is sent, or False if the user said not
+    to send it.
+    """
+    if use_async:
+        (error,) = send_async(
+            config=config,
+            mailfiles=[mailfile],
+            interactive=interactive,
+            timings=timings,
+        )
+        if error is SKIPPED:
+            return False
+        if error is not None:
+            raise error
+        return True
+    if pool is None:
+        with SMTPPool() as pool:
+            return send(
+                config=config,
+                mailfile=mailfile,
+                pool=pool,
+                interactive=interactive,
+                timings=timings,
+            )
+    say = print if interactive else lambda *args, **kwargs: None
+    with _timed(timings, "headers"):
+        headers = get_headers(mailfile)
+    if can_send_raw(headers):
+        say(
+            f'Sending {headers["subject"]!r} to {headers["to"]} ... ',
+            end="",
+            flush=True,
+        )
+        send_raw(
+            mailfile=mailfile,
+            headers=headers,
+            pool=pool,
+            timings=timings,
+            **smtp_settings(account_config(config, headers)),
+        )
+        say("OK")
+        move_to_sent(mailfile, sent_path(config, headers))
+        return True
+    outgoing = prepare_send(
+        config=config, mailfile=mailfile, interactive=interactive, timings=timings
+    )
+    if outgoing is None:
+        return False
+    config, msg, recipients, sentfile, attachments = outgoing
+    try:
+        if recipients is not None and mailing_list_mode(config) == "bulk":
+            with _timed(timings, "generate"):
+                (envelope,) = iter_envelopes(outgoing)
+            say(f"\tSending to {len(recipients)} recipients...", end="", flush=True)
+            try:
+                with _timed(timings, "deliver"):
+                    refused = pool.sendmail(
+                        envelope,
+                        batch_size=config.get(
+                            "MAILING_LIST_BATCH_SIZE", MAILING_LIST_BATCH_SIZE
+                        ),
+                        **smtp_settings(config),
+                    )
+            except smtplib.SMTPResponseException as e:
+                raise _delivery_error(msg, e) from e
+            if refused and set(refused) >= set(envelope.to_addrs):
+                say("REFUSED")
+                _report_refused(refused)
+                raise smtplib.SMTPRecipientsRefused(refused)
+            say("OK")
+            _report_refused(refused)
+        elif recipients is not None and mailing_list_mode(config) == "merge":
+            refused = {}
+            for envelope in _timed_iter(iter_envelopes(outgoing), timings, "generate"):
+                say(f"\tSending to {envelope.to_addrs[0]}...", end="", flush=True)
+                try:
+                    with _timed(timings, "deliver"):
+                        envelope_refused = pool.sendmail(
+                            envelope, **smtp_settings(config)
+                        )
+                except smtplib.SMTPResponseException as e:
+                    raise _delivery_error(msg, e) from e
+                if envelope_refused:
+                    say("REFUSED")
+                else:
+                    say("OK")
+                refused.update(envelope_refused)
+            _report_refused(refused)
+            if refused and len(refused) >= len(recipients):
+                raise smtplib.SMTPRecipientsRefused(refused)
+        elif recipients is not None:
+            for recipient in recipients:
+                address_to(msg, recipient)
+                say(f"\tSending to {recipient}...", end="", flush=True)
+                send_message(
+                    msg=msg,
+                    pool=pool,
+                    timings=timings,
+                    attachments=attachments,
+                    **smtp_settings(config),
+                )
+                say("OK")
+        else:
+            say(f'Sending {msg["subject"]!r} to {msg["to"]} ... ', end="", flush=True)
+            send_message(
+                msg=msg,
+                pool=pool,
+                timings=timings,
+                attachments=attachments,
+                **smtp_settings(config),
+            )
+            say("OK")
+    finally:
+        if attachments is not None:
+            attachments.file.close()
+    move_to_sent(mailfile, sentfile)
+    return True
+
+
+def show_timings(timings):
+    if timings is not None:
+        print("".join(timings.report()), end="")
+
+
+def _report_refused(refused):
+    for addr, (code, message) in refused.items():
+        print(f"\t{addr} refused - {code} {message.decode('utf-8', 'replace')}")
+
+
+def send_async(*, config, mailfiles, interactive=True, timings=None):
+    """
+    Send all of ``mailfiles`` at once on the asyncio engine, and move
+    each one to the sent folder once every delivery for it has gone.
+    Deliveries are made as fast as the connection limits allow - up to
+    ``SMTP_MAX_CONNECTIONS`` to each server - and envelopes are only
+    built as they're needed. Return the error, or None, for each file -
+    a file that every recipient refused counts as an error, and stays
+    put - or ``SKIPPED`` if the user said not to send it. Stages are timed in ``timings``, if given - deliveries overlap, so
+    their total can be more than the time taken.
+    """
+    errors = [None] * len(mailfiles)
+    to_addrs = [set() for _ in mailfiles]
+    refusals = [{} for _ in mailfiles]
+    outgoings = []
+    for i, mailfile in enumerate(mailfiles):
+        try:
+            outgoing = prepare_send(
+                config=config,
+                mailfile=mailfile,
+                interactive=interactive,
+                timings=timings,
+            )
+        except Exception as e:
+            errors[i] = e
+            outgoing = None
+        else:
+            if outgoing is None:
+                errors[i] = SKIPPED
+        outgoings.append(outgoing)
+
+    host_limits = {}
+    for outgoing in filter(None, outgoings):
+        host = outgoing.config.get("SMTP_HOST", "localhost")
+        host_limits.setdefault(
+            host, outgoing.config.get("SMTP_MAX_CONNECTIONS", SMTP_MAX_CONNECTIONS)
+        )
+
+    def iter_deliveries():
+        for i, outgoing in enumerate(outgoings):
+            if outgoing is None:
+                continue
+            envelopes = _timed_iter(iter_envelopes(outgoing), timings, "generate")
+            try:
+                for envelope in envelopes:
+                    yield i, envelope, outgoing.config
+            except Exception as e:
+                errors[i] = errors[i] or e
+
+    deliveries = iter_deliveries()
+
+    async def deliver_all():
+        async with AsyncSMTPPool() as pool:
+
+            async def worker():
+                # The workers share the deliveries generator, so each
+                # envelope is only built when there's a connection for it.
+                for i, envelope, account in deliveries:
+                    to_addrs[i].update(envelope.to_addrs)
+                    try:
+                        with _timed(timings, "deliver"):
+                            refused = await pool.sendmail(
+                                envelope,
+                                batch_size=account.get(
+                                    "MAILING_LIST_BATCH_SIZE", MAILING_LIST_BATCH_SIZE
+                                ),
+                                max_connections=account.get(
+                                    "SMTP_MAX_CONNECTIONS", SMTP_MAX_CONNECTIONS
+                                ),
+                                **smtp_settings(account),
+                            )
+                    except smtplib.SMTPResponseException as e:
+                        errors[i] = errors[i] or _delivery_error(outgoings[i].msg, e)
+                    except Exception as e:
+                        errors[i] = errors[i] or e
+                    else:
+                        _report_refused(refused)
+                        refusals[i].update(refused)
+
+            await asyncio.gather(*(worker() for _ in range(sum(host_limits.values()))))
+
+    try:
+        if host_limits:
+            if interactive:
+                count = sum(outgoing is not None for outgoing in outgoings)
+                print(
+                    f'Sending {count} message{"s" if count != 1 else ""} ... ',
+                    end="",
+                    flush=True,
+                )
+            asyncio.run(deliver_all())
+            if interactive:
+                print("Done")
+        for i, refused in enumerate(refusals):
+            # Like send_message - refusing everyone means it wasn't sent.
+            if refused and set(refused) >= to_addrs[i]:
+                errors[i] = errors[i] or smtplib.SMTPRecipientsRefused(refused)
+    finally:
+        for outgoing in filter(None, outgoings):
+            if outgoing.attachments is not None:
+                outgoing.attachments.file.close()
+    for mailfile, outgoing, error in zip(mailfiles, outgoings, errors):
+        if outgoing is not None and error is None:
+            move_to_sent(mailfile, outgoing.sentfile)
+    return errors
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_msg_date(value):
+    """
+    Parse an RFC 2822 date, like from the ``Date`` header, into an aware
+    datetime. Dates without a timezone are taken to be UTC. Results are
+    cached, and the common ``Day, DD Mon YYYY HH:MM:SS +ZZZZ`` shape is
+    handled without going through ``parsedate_to_datetime``.
+    """
+    match = _FAST_DATE.fullmatch(value)
+    if match and match[2].lower() in _MONTHS:
+        day, _, year, hour, minute, second, sign, tzhour, tzminute = match.groups()
+        offset = timedelta(hours=int(tzhour), minutes=int(tzminute))
+        try:
+            return datetime(
+                int(year),
+                _MONTHS[match[2].lower()],
+                int(day),
+                int(hour),
+                int(minute),
+                int(second),
+                tzinfo=timezone(-offset if sign == "-" else offset),
+            )
+        except ValueError:
+            # Something like 31 Feb - let the real parser sort it out.
+            pass
+    date = parsedate_to_datetime(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date
+
+
+@functools.lru_cache(maxsize=DATE_CACHE_SIZE)
+def date_key(value):
+    """
+    Return RFC 2822 date ``value`` as integer seconds since the epoch,
+    which is what messages get sorted by.
+    """
+    return int(parse_msg_date(value).timestamp())
+
+
+def _raw_header(headers, name):
+    """
+    Return the unparsed value of header ``name``, with whitespace and
+    folding collapsed, or ``None``. This skips the header registry, which
+    is handy for headers we'd rather parse ourselves, like ``Date``.
+    """
+    name = name.lower()
+    for key, value in headers.raw_items():
+        if key.lower() == name:
+            return " ".join(value.split()) or None
+    return None
+
+
+def _headers_date(headers, *, mtime):
+    date = _raw_header(headers, "date")
+    if date:
+        try:
+            return parse_msg_date(date)
+        except (TypeError, ValueError):
+            pass
+    return datetime.fromtimestamp(mtime, LOCAL_TZ)
+
+
+def read_header_bytes(f, *, chunk_size=HEADER_CHUNK_SIZE):
+    """
+    Read the raw headers from binary file ``f``, up to and including the
+    blank line that separates them from the body. The body itself is
+    never read, so this costs the same for a 2KB message as it does for
+    one with a 20MB attachment.
+    """
+    data = bytearray()
+    while True:
+        # The blank line may straddle two chunks, so back up a little.
+        start = max(len(data) - 3, 0)
+        chunk = f.read(chunk_size)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+        match = _HEADER_END.search(data, start)
+        if match:
+            return bytes(data[: match.end()])
+
+
+def parse_headers(f):
+    """
+    Parse just the headers from binary file ``f``. Folded headers and
+    RFC 2047 encoded words are handled by the header parser as usual.
+    """
+    return _header_parser.parsebytes(read_header_bytes(f))
+
+
+@functools.lru_cache(maxsize=HEADER_CACHE_SIZE)
+def _cached_headers(path, size, mtime_ns):
+    with open(path, "rb") as f:
+        return parse_headers(f)
+
+
+def get_headers(file, *, stat=None):
+    """
+    Return the parsed headers of ``file``. Headers are cached by path,
+    size, and mtime, so a file is only parsed once per run no matter how
+    many times it's asked for. The result is shared - don't modify it.
+    """
+    stat = stat or os.stat(file)
+    return _cached_headers(str(file), stat.st_size, stat.st_mtime_ns)
+
+
+def get_msg_date(file, *, stat=None):
+    stat = stat or os.stat(file)
+    return _headers_date(get_headers(file, stat=stat), mtime=stat.st_mtime)
+
+
+def scan_maildir(maildir):
+    """
+    Yield an ``os.DirEntry`` for each message file in ``maildir``.
+    Dotfiles are skipped, as Maildir readers are supposed to ignore them -
+    conveniently that includes our index. ``DirEntry`` caches its stat
+    result, so pass ``entry.stat()`` along rather than statting again.
+    """
+    with os.scandir(maildir) as entries:
+        for entry in entries:
+            if not entry.name.startswith(".") and entry.is_file():
+                yield entry
+
+
+def decoded_size(size, *, encoding):
+    """
+    Estimate the decoded size of a body that's ``size`` bytes in transfer
+    ``encoding``, without decoding it. Base64 is assumed to be in the
+    usual 76 character lines.
+    """
+    if encoding == "base64":
+        return size * 57 // 77
+    return size
+
+
+def summarize_parts(file, *, headers=None):
+    """
+    Return a ``PartSummary`` for each part of ``file``, in the same
+    order as ``mime_tree``. Multipart containers have no size. If the
+    message's ``headers`` have already been parsed, a message that isn't
+    multipart is summarized from them without walking the MIME tree.
+    """
+    if headers is not None:
+        content_type, filename, _, _ = content_info(headers)
+        if not content_type.startswith("multipart/"):
+            with open(file, "rb") as f:
+                body_start = len(read_header_bytes(f))
+                size = os.fstat(f.fileno()).st_size - body_start
+            size = decoded_size(size, encoding=transfer_encoding(headers))
+            return [PartSummary(0, content_type, filename, size)]
+    summaries = []
+    with map_mailfile(file) as data:
+        for part in mime_tree(data):
+            size = None
+            if not part.content_type.startswith("multipart/"):
+                size = decoded_size(part.end - part.body_start, encoding=part.encoding)
+            summaries.append(
+                PartSummary(part.depth, part.content_type, part.filename, size)
+            )
+    return summaries
+
+
+def load_parts(parts):
+    """
+    Return the ``PartSummary`` list for a record's JSON ``parts``.
+    """
+    return [PartSummary(*part) for part in json.loads(parts)]
+
+
+def _index_row(file, stat):
+    headers = get_headers(file, stat=stat)
+    date = _raw_header(headers, "date")
+    try:
+        timestamp = date_key(date)
+    except (TypeError, ValueError):
+        date = None
+        timestamp = int(stat.st_mtime)
+    sender = headers["from"] or headers["sender"]
+    message_id = headers["message-id"]
+    return (
+        file.name,
+        make_short_id(str(message_id).strip() if message_id else file.name),
+        stat.st_size,
+        stat.st_mtime_ns,
+        timestamp,
+        date,
+        None if sender is None else str(sender),
+        None if headers["subject"] is None else str(headers["subject"]),
+        None if message_id is None else str(message_id),
+        # Parts are only summarized when they're asked for.
+        None,
+        None,
+    )
+
+
+def _row_timestamp(row):
+    return row[4]
+
+
+def _index_rows(entries):
+    """
+    Return the index rows for ``entries`` of ``(file, stat)``, in date
+    order. This is what gets run in the worker processes on a parallel
+    refresh, so it only takes and returns plain picklable data.
+    """
+    rows = [_index_row(file, stat) for file, stat in entries]
+    rows.sort(key=_row_timestamp)
+    return rows
+
+
+class MailIndex:
+    """
+    Persistent header index for a single maildir folder, stored as an
+    SQLite database in the folder itself. Entries are keyed by filename,
+    size, and mtime, so only new or changed files ever get parsed. Only
+    headers are read to index a file - summarizing its parts means reading
+    the body, so that's left to ``summarize`` for when they're wanted.
+
+    If the index can't be written (e.g. a read-only folder), an in-memory
+    index is used instead.
+    """
+
+    SCHEMA_VERSION = 5
+
+    def __init__(self, *, maildir):
+        self.maildir = Path(maildir)
+        index = self.maildir / INDEX_FILENAME
         try:
-            template = templates[int(choice) - 1]
-        except (IndexError, ValueError):
-            print(f"Invalid choice {choice!r}")
+            # Opening an up to date index doesn't write anything, so
+            # check up front that refreshing it will be able to.
+            if not os.access(self.maildir, os.W_OK) or (
+                os.access(index, os.F_OK) and not os.access(index, os.W_OK)
+            ):
+                raise PermissionError(f"{index} is not writable")
+            self.db = sqlite3.connect(str(index))
+            self._create_schema()
+        except (OSError, sqlite3.Error) as e:
+            log.debug(f"Unable to use index in {self.maildir}: {e}")
+            self.db = sqlite3.connect(":memory:")
+            self._create_schema()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def _create_schema(self):
+        (version,) = self.db.execute("PRAGMA user_version").fetchone()
+        if version == self.SCHEMA_VERSION:
+            return
+        with self.db:
+            self.db.execute("DROP TABLE IF EXISTS messages")
+            self.db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS messages (
+                    name TEXT PRIMARY KEY,
+                    short_id TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime INTEGER NOT NULL,
+                    timestamp INTEGER NOT NULL,
+                    date TEXT,
+                    sender TEXT,
+                    subject TEXT,
+                    message_id TEXT,
+                    attachments INTEGER,
+                    parts TEXT
+                )
+                """
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS messages_by_date"
+                " ON messages (timestamp, name)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS messages_by_short_id"
+                " ON messages (short_id)"
+            )
+            self.db.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+
+    def refresh(self, *, jobs=1):
+        """
+        Bring the index up to date with the folder - parse new or changed
+        files, and forget about the ones that have gone away.
+
+        With ``jobs`` > 1 and enough new files, e.g. the first time a big
+        folder is seen, the headers are parsed across a pool of ``jobs``
+        processes, ``INDEX_CHUNK_SIZE`` files at a time.
+        """
+        known = {
+            name: (size, mtime)
+            for name, size, mtime in self.db.execute(
+                "SELECT name, size, mtime FROM messages"
+            )
+        }
+        stale = []
+        for entry in scan_maildir(self.maildir):
+            stat = entry.stat()
+            if known.pop(entry.name, None) != (stat.st_size, stat.st_mtime_ns):
+                stale.append((Path(entry.path), stat))
+        if jobs > 1 and len(stale) > INDEX_CHUNK_SIZE:
+            chunks = [
+                stale[i : i + INDEX_CHUNK_SIZE]
+                for i in range(0, len(stale), INDEX_CHUNK_SIZE)
+            ]
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                rows = list(
+                    heapq.merge(*pool.map(_index_rows, chunks), key=_row_timestamp)
+                )
         else:
-            done = True
-    draft = create_draft(template=template.content, config=config)
-    subprocess.call([config["EDITOR"], draft])
-    choice = action_prompt()
-    if choice == "s":
-        print("^C to cancel sending")
-        timer = config.get("ABORT_TIMEOUT", 5)
-        for sec in range(timer):
+            rows = _index_rows(stale)
+        with self.db:
+            self.db.executemany(
+                "DELETE FROM messages WHERE name = ?", ((name,) for name in known)
+            )
+            self.db.executemany(
+                "INSERT OR REPLACE INTO messages"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+
+    def summarize(self, names=None):
+        """
+        Fill in the part summaries of the files ``names``, or of every
+        file, that haven't been summarized yet. A summary is kept until
+        the file's size or mtime changes, like the rest of its entry.
+        """
+        if names is None:
+            names = [
+                name
+                for (name,) in self.db.execute(
+                    "SELECT name FROM messages WHERE parts IS NULL"
+                )
+            ]
+        rows = []
+        for name in names:
+            file = self.maildir / name
             try:
-                print(f"\rSending in {timer-sec}...[0K", end="")
-                sys.stdout.flush()
-                time.sleep(1)
-            except KeyboardInterrupt:
-                print("\r^C caught, draft saved.[0K")
-                break
-        else:
-            print("\rSending now...[0K")
-            stage_name = draft.parent.parent / "outbox" / draft.name
-            draft.rename(stage_name)
-            send(config=config, mailfile=stage_name)
-            staged_email_count = len(list((maildir / "outbox").iterdir()))
-            if staged_email_count:
-                print(
-                    f"{staged_email_count} emails to send. Run `{sys.argv[0]} send_all` to send."
+                stat = file.stat()
+                parts = summarize_parts(file, headers=get_headers(file, stat=stat))
+            except FileNotFoundError:
+                continue
+            rows.append(
+                (
+                    sum(1 for part in parts if part.filename and part.size is not None),
+                    json.dumps(parts),
+                    name,
+                    stat.st_size,
+                    stat.st_mtime_ns,
                 )
-    elif choice == "q":
-        stage_name = draft.parent.parent / "outbox" / draft.name
-        draft.rename(stage_name)
-        print(f"Email queued as {stage_name}")
-    elif choice == "v":
-        with draft.open("rb") as f:
-            headers = _header_parser.parse(f)
-        subject = subjectify(msg=headers)
-        new_name = draft.parent / _make_draftname(subject=subject)
-        draft.rename(new_name)
-        print(f"Draft saved as {new_name}")
-    elif choice == "d":
-        choice = input("Really delete draft? Cannot be undone! [y/N]: ")
-        if choice.lower() in ("y", "yes", "ja", "si", "oui"):
-            draft.unlink()
-
+            )
+        with self.db:
+            # A file that changed since the last refresh is left for the
+            # next one, rather than giving its old entry the new parts.
+            self.db.executemany(
+                "UPDATE messages SET attachments = ?, parts = ?"
+                " WHERE name = ? AND size = ? AND mtime = ? AND parts IS NULL",
+                rows,
+            )
 
-def send_all(*, config):
-    maildir = config["maildir"]
-    outbox = maildir / "outbox"
-    sentdir = maildir / "sent"
-    to_send = list(outbox.iterdir())
-    if not to_send:
-        print("Nothing to send.")
-        return
-    print("Going to send...")
-    for mailfile in to_send:
-        print(mailfile)
-    choice = input("Really send all? [Y/n]: ")
-    if choice.lower().strip() not in ("", "y", "yes", "si", "oui", "ja"):
-        print("Aborted!")
-        return
-    for mailfile in to_send:
-        send(config=config, mailfile=mailfile)
-    print("Done!")
+    _RECORD_COLUMNS = (
+        "name, short_id, timestamp, date, sender, subject, message_id, size, parts"
+    )
 
+    def _record(self, row):
+        name, *rest = row
+        return MailRecord(self.maildir / name, *rest)
 
-def send(*, config, mailfile):
-    msg = _parser.parsebytes(mailfile.read_bytes())
-    prettyname = f"{prettynow()}-{subjectify(msg=msg)}.eml"
-    sentfile = config["maildir"] / "sent" / prettyname
-    from_addr = parseaddr(msg["from"])[1]
-    config = config.copy()
-    if from_addr in config:
-        config.update(config[from_addr])
-    msg = commonmarkdown(msg)
-    msg = attachify(msg)
-    mailing_list = msg.get("X-MailingList")
-    if mailing_list:
-        recipients = [
-            r for r in config.get("mailing_list", {}).get(mailing_list) if r.strip()
-        ]
-        choice = input(f"Sending to {len(recipients)}, continue? [Y/n]: ")
-        if choice.lower().strip() in ("n", "no"):
-            print("Aborted")
-            return
-        for recipient in recipients:
-            for field in ("to", "cc", "bcc"):
-                try:
-                    del msg[field]
-                except KeyError:
-                    pass
-            msg["To"] = recipient
-            print(f"\tSending to {recipient}...", end="")
-            sys.stdout.flush()
-            send_message(
-                msg=msg,
-                smtp_host=config.get("SMTP_HOST", "localhost"),
-                smtp_port=config.get("SMTP_PORT", 25),
-                use_tls=config.get("SMTP_USE_TLS", False),
-                use_smtps=config.get("SMTP_USE_SMTPS", False),
-                username=config.get("SMTP_USERNAME", False),
-                password=config.get("SMTP_PASSWORD", False),
+    def names(self):
+        """
+        Return a list of the indexed filenames, oldest first.
+        """
+        return [
+            name
+            for (name,) in self.db.execute(
+                "SELECT name FROM messages ORDER BY timestamp, name"
             )
-            print("OK")
-    else:
-        print(f'Sending {msg["subject"]!r} to {msg["to"]} ... ', end="")
-        sys.stdout.flush()
-        send_message(
-            msg=msg,
-            smtp_host=config.get("SMTP_HOST", "localhost"),
-            smtp_port=config.get("SMTP_PORT", 25),
-            use_tls=config.get("SMTP_USE_TLS", False),
-            use_smtps=config.get("SMTP_USE_SMTPS", False),
-            username=config.get("SMTP_USERNAME", False),
-            password=config.get("SMTP_PASSWORD", False),
-        )
-        print("OK")
-    sentfile.parent.mkdir(parents=True, exist_ok=True)
-    mailfile.rename(sentfile)
+        ]
 
+    def record(self, name):
+        """
+        Return the ``MailRecord`` for the file ``name``, or ``None``.
+        """
+        row = self.db.execute(
+            f"SELECT {self._RECORD_COLUMNS} FROM messages WHERE name = ?", (name,)
+        ).fetchone()
+        return None if row is None else self._record(row)
 
-def get_msg_date(file):
-    file = Path(file)
-    with file.open("rb") as f:
-        headers = _header_parser.parse(f)
-    msg_timestamp = datetime.fromtimestamp(file.stat().st_mtime, LOCAL_TZ)
-    if headers["date"]:
-        msg_timestamp = parsedate_to_datetime(headers["date"])
-        if msg_timestamp.tzinfo is None:
-            msg_timestamp = msg_timestamp.replace(tzinfo=timezone.utc)
-    return msg_timestamp
+    def lookup(self, short_id):
+        """
+        Return the path of the message with ``short_id``, or ``None``.
+        This only consults the index, it doesn't refresh it.
+        """
+        row = self.db.execute(
+            "SELECT name FROM messages WHERE short_id = ?"
+            " ORDER BY timestamp, name LIMIT 1",
+            (short_id,),
+        ).fetchone()
+        return None if row is None else self.maildir / row[0]
+
+    def page(
+        self, *, since=None, until=None, limit=None, offset=0, with_attachments=False
+    ):
+        """
+        Return a list of ``(number, record)`` for the newest ``limit``
+        messages dated from ``since`` up to ``until``, skipping the newest
+        ``offset``, oldest first. ``number`` is the message number, as if
+        nothing was filtered out. The date index means that only the
+        requested records are ever loaded.
+        """
+        conditions = []
+        params = []
+        if since is not None:
+            conditions.append("timestamp >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("timestamp < ?")
+            params.append(until)
+        if with_attachments:
+            conditions.append("attachments > 0")
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        params.extend([-1 if limit is None else limit, offset])
+        if with_attachments:
+            # Skipped messages leave gaps in the numbering, so number
+            # every message first and then filter.
+            rows = self.db.execute(
+                f"SELECT number, {self._RECORD_COLUMNS} FROM (SELECT *,"
+                " ROW_NUMBER() OVER (ORDER BY timestamp, name) AS number"
+                f" FROM messages){where} ORDER BY timestamp DESC, name DESC"
+                " LIMIT ? OFFSET ?",
+                params,
+            ).fetchall()
+            rows.reverse()
+            return [(number, self._record(row)) for number, *row in rows]
+
+        (total,) = self.db.execute(
+            f"SELECT COUNT(*) FROM messages{where}", params[:-2]
+        ).fetchone()
+        before = 0
+        if since is not None:
+            (before,) = self.db.execute(
+                "SELECT COUNT(*) FROM messages WHERE timestamp < ?", (since,)
+            ).fetchone()
+        rows = self.db.execute(
+            f"SELECT {self._RECORD_COLUMNS} FROM messages{where}"
+            " ORDER BY timestamp DESC, name DESC LIMIT ? OFFSET ?",
+            params,
+        ).fetchall()
+        rows.reverse()
+        number = before + total - offset - len(rows) + 1
+        return list(enumerate(map(self._record, rows), start=number))
 
 
 def sorted_mailfiles(*, maildir):
-    msg_list = [file for file in maildir.iterdir() if file.is_file()]
-    msg_list.sort(key=get_msg_date)
-    return msg_list
+    with MailIndex(maildir=maildir) as index:
+        index.refresh()
+        return [maildir / name for name in index.names()]
+
+
+def make_short_id(key):
+    """
+    Return a stable short id for ``key`` - the Message-ID, or the
+    filename for messages that don't have one.
+    """
+    digest = hashlib.sha1(key.encode("utf-8", "surrogateescape")).hexdigest()
+    return digest[:SHORT_ID_LENGTH].translate(_SHORT_ID_TRANS)
+
+
+def is_short_id(value):
+    return len(value) == SHORT_ID_LENGTH and _SHORT_ID_CHARS.issuperset(value)
+
+
+def resolve_mailfile(*, maildir, mailnumber):
+    """
+    Return the path of message ``mailnumber`` in ``maildir``. That's
+    either the number from ``list``, or the stable id from ``list --ids``.
+    Ids are looked up directly in the index, without sorting the folder.
+
+    Raise ``IndexError`` if there's no such message, or ``WEmailError``
+    if ``mailnumber`` is neither a number nor an id.
+    """
+    mailnumber = str(mailnumber)
+    if not is_short_id(mailnumber):
+        try:
+            number = abs(int(mailnumber))
+        except ValueError:
+            raise WEmailError(f"Not a message number or id: {mailnumber!r}")
+        return sorted_mailfiles(maildir=maildir)[number - 1]
+    with MailIndex(maildir=maildir) as index:
+        mailfile = index.lookup(mailnumber)
+        if mailfile is None or not mailfile.exists():
+            index.refresh()
+            mailfile = index.lookup(mailnumber)
+    if mailfile is None:
+        raise IndexError(f"No message with id {mailnumber!r}")
+    return mailfile
 
 
 def iter_headers(*, maildir):
     for file in sorted_mailfiles(maildir=maildir):
-        with file.open("rb") as f:
-            headers = _header_parser.parse(f)
-        yield headers
-
-
-def wrapped(content):
-    max_width = min(80, shutil.get_terminal_size((80, 24)).columns)
-    new_content = io.StringIO()
-    content = content.decode()
-    printed = 0
-    for i, char in enumerate(content):
-        if char == " ":
-            if i + 1 < len(content) and content[i + 1] == ".":
-                # If the space comes before a period, why bother?
-                continue
-            else:
-                next_space = content.find(" ", i + 1)
-                # It's possible there is no next space. If
-                # this space is the last one and we've already
-                # printed too many characters, it's wrapping time!
-                spaces_until = max(next_space - i, 0)
-                if printed + spaces_until > max_width:
-                    print(file=new_content)
-                    printed = 0
-                else:
-                    print(char, end="", file=new_content)
+        yield get_headers(file)
+
+
+def wrap_width():
+    """
+    Return the width to wrap text at - 80, or the terminal width,
+    whichever is smaller.
+    """
+    return min(80, shutil.get_terminal_size((80, 24)).columns)
+
+
+def _wrap_line(line, *, width, ending):
+    if line.endswith("\r"):
+        line = line[:-1]
+        ending = "\r" + ending
+    if len(line) <= width:
+        yield line + ending
+        return
+    words = []
+    length = -1
+    for word in line.split(" "):
+        if words and length + 1 + len(word) > width:
+            yield " ".join(words) + "\n"
+            words = [word]
+            length = len(word)
         else:
-            print(char, end="", file=new_content)
-            if char == "\n":
-                printed = 0
-            else:
-                printed += 1
-    new_content.seek(0)
-    return new_content.read().encode()
+            words.append(word)
+            length += 1 + len(word)
+    yield " ".join(words) + ending
+
+
+def iter_wrapped(chunks, *, width):
+    """
+    Word wrap the text from ``chunks``, an iterable of strings that may
+    split lines (or words) anywhere, yielding lines of at most ``width``
+    characters, line endings included. Lines are broken at spaces, and
+    words that are too long get a line to themselves.
+    """
+    partial = []
+    for chunk in chunks:
+        lines = chunk.split("\n")
+        partial.append(lines[0])
+        if len(lines) == 1:
+            continue
+        yield from _wrap_line("".join(partial), width=width, ending="\n")
+        for line in lines[1:-1]:
+            yield from _wrap_line(line, width=width, ending="\n")
+        partial = [lines[-1]]
+    line = "".join(partial)
+    if line:
+        yield from _wrap_line(line, width=width, ending="")
+
+
+@contextlib.contextmanager
+def map_mailfile(mailfile):
+    """
+    Memory-map ``mailfile`` for reading. Files that can't be mapped, like
+    empty ones, are just read instead.
+    """
+    with open(mailfile, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            yield f.read()
+            return
+        with data:
+            yield data
+
+
+def _part_ranges(data, boundary, start, end):
+    """
+    Yield the ``(start, end)`` of each body part between ``boundary``
+    delimiters in ``data[start:end]``. The line break before a delimiter
+    belongs to the delimiter, not the part.
+    """
+    delimiter = b"--" + boundary.encode("ascii", "surrogateescape")
+    part_start = None
+    pos = start
+    while True:
+        if pos == start and data[start : start + len(delimiter)] == delimiter:
+            found = part_end = start
+        else:
+            found = data.find(b"\n" + delimiter, pos, end)
+            if found == -1:
+                break
+            part_end = found - 1 if data[found - 1 : found] == b"\r" else found
+            found += 1
+        after = found + len(delimiter)
+        if data[after : after + 1] not in (b"", b"-", b"\r", b"\n", b" ", b"\t"):
+            # Only a prefix of some other boundary, keep looking.
+            pos = after
+            continue
+        if part_start is not None:
+            yield part_start, max(part_end, part_start)
+        if data[after : after + 2] == b"--":
+            return
+        line_end = data.find(b"\n", after, end)
+        if line_end == -1:
+            return
+        part_start = line_end + 1
+        pos = line_end
+    if part_start is not None:
+        yield part_start, end
+
+
+def content_info(headers, *, default_type="text/plain"):
+    """
+    Return the ``(content_type, filename, charset, boundary)`` of an
+    entity from its ``headers``, the same as ``get_content_type`` and
+    friends would. Each of those runs Content-Type back through the
+    header registry, so this fetches it, and Content-Disposition, once.
+    """
+    header = headers.get("content-type")
+    if header is None:
+        content_type, params = default_type, {}
+    else:
+        content_type, params = header.content_type, header.params
+    disposition = headers.get("content-disposition")
+    filename = disposition and disposition.params.get("filename")
+    charset = params.get("charset")
+    boundary = params.get("boundary")
+    return (
+        content_type,
+        filename or params.get("name"),
+        charset and charset.lower(),
+        boundary and boundary.rstrip(),
+    )
+
+
+def transfer_encoding(headers):
+    return (_raw_header(headers, "content-transfer-encoding") or "7bit").lower()
+
+
+def mime_tree(data, *, start=0, end=None, depth=0, default_type="text/plain"):
+    """
+    Yield a ``MimePart`` for each entity in the message in ``data``,
+    which can be bytes or an mmap, in the same order as ``msg.walk()``.
+    Only headers are parsed - parts record where their body lives in
+    ``data``, so nothing gets decoded until it's asked for. Attached
+    messages (``message/rfc822``) are treated as a single part.
+    """
+    end = len(data) if end is None else end
+    if data[start : start + 1] == b"\n" or data[start : start + 2] == b"\r\n":
+        body_start = data.find(b"\n", start, end) + 1
+    else:
+        match = _HEADER_END.search(data, start, end)
+        body_start = end if match is None else match.end()
+    headers = _header_parser.parsebytes(bytes(data[start:body_start]))
+    headers.set_default_type(default_type)
+    content_type, filename, charset, boundary = content_info(
+        headers, default_type=default_type
+    )
+    yield MimePart(
+        content_type=content_type,
+        filename=filename,
+        encoding=transfer_encoding(headers),
+        charset=charset,
+        start=start,
+        body_start=body_start,
+        end=end,
+        depth=depth,
+        headers=headers,
+    )
+    if content_type.startswith("multipart/") and boundary:
+        child_type = (
+            "message/rfc822" if content_type == "multipart/digest" else "text/plain"
+        )
+        for part_start, part_end in _part_ranges(data, boundary, body_start, end):
+            yield from mime_tree(
+                data,
+                start=part_start,
+                end=part_end,
+                depth=depth + 1,
+                default_type=child_type,
+            )
+
+
+def leaf_parts(tree):
+    """
+    Return the parts of ``tree`` that aren't multipart containers. These
+    are what part numbers refer to.
+    """
+    return [part for part in tree if not part.content_type.startswith("multipart/")]
+
+
+def _iter_base64(data, start, end, chunk_size):
+    leftover = b""
+    for pos in range(start, end, chunk_size):
+        encoded = leftover + bytes(data[pos : min(pos + chunk_size, end)]).translate(
+            None, _NOT_BASE64
+        )
+        usable = len(encoded) - len(encoded) % 4
+        leftover = encoded[usable:]
+        yield binascii.a2b_base64(encoded[:usable])
+    if leftover:
+        try:
+            yield binascii.a2b_base64(leftover + b"=" * (-len(leftover) % 4))
+        except binascii.Error:
+            pass
+
+
+def _iter_quoted_printable(data, start, end, chunk_size):
+    leftover = b""
+    for pos in range(start, end, chunk_size):
+        encoded = leftover + bytes(data[pos : min(pos + chunk_size, end)])
+        # Only decode whole lines, or at least whole =XX escapes, so
+        # soft line breaks and escapes never get split.
+        cut = encoded.rfind(b"\n") + 1
+        if not cut:
+            escape = encoded.find(b"=", len(encoded) - 2)
+            cut = len(encoded) if escape == -1 else escape
+        leftover = encoded[cut:]
+        yield binascii.a2b_qp(encoded[:cut])
+    if leftover:
+        yield binascii.a2b_qp(leftover)
+
+
+def iter_decoded(data, part, *, chunk_size=DECODE_CHUNK_SIZE):
+    """
+    Yield the decoded payload of ``part`` a chunk at a time, undoing any
+    base64 or quoted-printable encoding as it goes, so that memory use
+    doesn't depend on how big the part is.
+    """
+    if part.encoding == "base64":
+        yield from _iter_base64(data, part.body_start, part.end, chunk_size)
+    elif part.encoding == "quoted-printable":
+        yield from _iter_quoted_printable(data, part.body_start, part.end, chunk_size)
+    elif part.encoding in ("7bit", "8bit", "binary"):
+        for pos in range(part.body_start, part.end, chunk_size):
+            yield bytes(data[pos : min(pos + chunk_size, part.end)])
+    else:
+        # Something rare, like uuencode - let the email package handle it.
+        msg = _parser.parsebytes(bytes(data[part.start : part.end]))
+        yield msg.get_payload(decode=True)
+
+
+def iter_text(chunks, *, charset=None):
+    """
+    Decode the byte ``chunks`` as ``charset`` text, falling back to UTF-8
+    for missing or unknown charsets.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(charset or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
 
 
 def iter_messages(*, maildir):
@@ -827,67 +3256,241 @@ def iter_messages(*, maildir):
         yield msg
 
 
-def list_messages(*, config):
+def human_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            break
+        size /= 1024
+    return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+
+
+def format_parts(parts, *, attachments_only=False, indent=""):
+    """
+    Return the lines describing ``parts``, numbered the same way as the
+    parts for ``read`` and ``attachment``.
+    """
+    lines = []
+    number = 0
+    for part in parts:
+        pad = indent + "  " * part.depth
+        if part.size is None:
+            if not attachments_only:
+                lines.append(f"{pad}{part.content_type}\n")
+            continue
+        number += 1
+        if attachments_only and not part.filename:
+            continue
+        filename = f" {part.filename}" if part.filename else ""
+        lines.append(
+            f"{pad}{number}. {part.content_type}{filename} ({human_size(part.size)})\n"
+        )
+    return lines
+
+
+def list_messages(
+    *,
+    config,
+    show_ids=False,
+    limit=None,
+    offset=0,
+    since=None,
+    until=None,
+    with_attachments=False,
+    jobs=1,
+):
+    """
+    Print the messages in the current folder, oldest first. ``limit`` and
+    ``offset`` pick a page counting back from the newest message, and
+    ``since``/``until`` restrict the dates. ``with_attachments`` only
+    lists messages with attachments, along with the attachments. Message
+    numbers are always the same as for an unrestricted listing. ``jobs``
+    is the number of processes used to index new messages.
+    """
     # TODO: This should be configurable between curdir and the absolute maildir -W. Werner, 2020-08-14
     maildir = config["curdir"]
-    for i, msg in enumerate(iter_headers(maildir=maildir), start=1):
-        if "date" in msg:
-            date = parsedate_to_datetime(msg["date"])
+    with MailIndex(maildir=maildir) as index:
+        index.refresh(jobs=jobs)
+        if with_attachments:
+            index.summarize()
+        records = index.page(
+            since=since and since.timestamp(),
+            until=until and until.timestamp(),
+            limit=limit,
+            offset=offset,
+            with_attachments=with_attachments,
+        )
+    lines = []
+    for i, record in records:
+        if record.date:
+            date = parse_msg_date(record.date)
             date_str = f"{date:%Y-%m-%d %H:%M}"
         else:
             date_str = f"{'Unknown':<16}"
-        subject = msg["subject"]
+        short_id = f"{record.short_id} " if show_ids else ""
         # TODO: There are a number of headers this could be -W. Werner, 2019-11-22
-        sender = msg["from"] or msg["sender"]
-        print(f"{i:>2}. {date_str} - {sender} - {subject}")
+        lines.append(
+            f"{i:>2}. {short_id}{date_str} - {record.sender} - {record.subject}\n"
+        )
+        if with_attachments:
+            lines.extend(
+                format_parts(
+                    load_parts(record.parts), attachments_only=True, indent="    "
+                )
+            )
+        if len(lines) >= LIST_BATCH_SIZE:
+            sys.stdout.write("".join(lines))
+            lines.clear()
+    sys.stdout.write("".join(lines))
+
+
+def show_parts(*, config, mailnumber):
+    """
+    Print the MIME structure of a message from the index. Its body is
+    only read the first time, to summarize it.
+    """
+    mailfile = resolve_mailfile(maildir=config["curdir"], mailnumber=mailnumber)
+    with MailIndex(maildir=config["curdir"]) as index:
+        record = index.record(mailfile.name)
+        if record is None:
+            index.refresh()
+            record = index.record(mailfile.name)
+        if record.parts is None:
+            index.summarize([mailfile.name])
+            record = index.record(mailfile.name)
+    sys.stdout.write("".join(format_parts(load_parts(record.parts))))
 
 
 def raw(*, config, mailnumber):
-    mailfile = sorted_mailfiles(maildir=config["curdir"])[mailnumber - 1]
+    mailfile = resolve_mailfile(maildir=config["curdir"], mailnumber=mailnumber)
     subprocess.run([config["EDITOR"], mailfile.resolve()])
 
 
-def read(*, config, mailnumber, all_headers=False, part=None, wrap=False):
-    message_iter = iter_messages(maildir=config["curdir"])
-    # TODO: This works but it doesn't have comprehensive test coverage -W. Werner, 2019-12-06
-    # Also there is another issue. If there is a part with a filename, we should try and respect that filename. This should kind of get unwound. Also it's not super effective
-    # to go parsing all of the emails *shrugs*
-    for i, msg in zip(range(mailnumber), message_iter):
-        pass
-    with tempfile.NamedTemporaryFile(suffix=".eml") as tempmail:
-        if all_headers:
-            tempmail.write(msg.as_bytes().split(b"\n\n")[0])
-        else:
-            for header in DISPLAY_HEADERS:
-                if header in msg:
-                    tempmail.write(f"{header}: {msg[header]}\n".encode())
+def view_cache_file(*, config, mailfile, part, width, all_headers):
+    """
+    Return the path of the cached rendered view of ``part`` of
+    ``mailfile``, or None if the view cache is turned off. The key is the
+    file's identity - path, size, and mtime - so editing a message in
+    place gets it a fresh entry, and stale ones just age out.
+    """
+    if not config.get("view_cache_size", VIEW_CACHE_SIZE):
+        return None
+    cache_dir = Path(
+        config.get("view_cache_dir", config["maildir"] / ".view-cache")
+    ).expanduser()
+    stat = os.stat(mailfile)
+    key = repr(
+        (
+            str(Path(mailfile).resolve()),
+            stat.st_size,
+            stat.st_mtime_ns,
+            part.start,
+            width,
+            all_headers,
+        )
+    )
+    return cache_dir / (hashlib.sha256(key.encode()).hexdigest() + ".eml")
 
-        tempmail.write(b"\n\n")
 
-        if not msg.is_multipart():
-            if wrap:
-                tempmail.write(wrapped(msg.get_payload(decode=True)))
-            else:
-                tempmail.write(msg.get_payload(decode=True))
+def prune_view_cache(cache_dir, *, max_size):
+    """
+    Remove the least recently used views from ``cache_dir`` until the
+    rest add up to no more than ``max_size`` bytes.
+    """
+    with os.scandir(cache_dir) as entries:
+        views = [
+            (entry.stat().st_mtime_ns, entry.stat().st_size, entry.path)
+            for entry in entries
+            if entry.is_file() and entry.name.endswith(".eml")
+        ]
+    total = sum(size for _, size, _ in views)
+    for _, size, path in sorted(views):
+        if total <= max_size:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
+        total -= size
+
+
+def cache_view(*, config, view, cache_file):
+    """
+    Copy the rendered ``view`` file into the view cache as
+    ``cache_file``, then prune the cache back down to size. A cache that
+    can't be written to just means the next read is a little slower.
+    """
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(
+            dir=cache_file.parent, suffix=".tmp", delete=False
+        ) as f:
+            shutil.copyfile(view, f.name)
+        os.replace(f.name, cache_file)
+        prune_view_cache(
+            cache_file.parent,
+            max_size=config.get("view_cache_size", VIEW_CACHE_SIZE),
+        )
+    except OSError as e:
+        log.debug(f"Unable to cache view {cache_file}: {e}")
+
+
+def read(*, config, mailnumber, all_headers=False, part=None, wrap=False):
+    # TODO: This works but it doesn't have comprehensive test coverage -W. Werner, 2019-12-06
+    # Also there is another issue. If there is a part with a filename, we should try and respect that filename. This should kind of get unwound.
+    mailfile = resolve_mailfile(maildir=config["curdir"], mailnumber=mailnumber)
+    with map_mailfile(mailfile) as data, tempfile.NamedTemporaryFile(
+        suffix=".eml"
+    ) as tempmail:
+        tree = list(mime_tree(data))
+        if len(tree) == 1:
+            msgpart = tree[0]
         else:
             parts = []
             i = 1
-            for msgpart in msg.walk():
-                content_type = msgpart.get_content_type()
-                if content_type.startswith("multipart/"):
-                    print(content_type)
+            for msgpart in tree:
+                if msgpart.content_type.startswith("multipart/"):
+                    print(msgpart.content_type)
                 else:
                     parts.append(msgpart)
-                    print(f"\t{i}. {content_type}")
+                    print(f"\t{i}. {msgpart.content_type}")
                     i += 1
             msgpart = parts[
                 (part or config.get("default_part") or int(input("What part? "))) - 1
             ]
+        width = wrap_width() if wrap else None
+        cache_file = view_cache_file(
+            config=config,
+            mailfile=mailfile,
+            part=msgpart,
+            width=width,
+            all_headers=all_headers,
+        )
+        if cache_file is not None and cache_file.is_file():
+            with open(cache_file, "rb") as f:
+                shutil.copyfileobj(f, tempmail)
+            # Touch it, so eviction knows it was used recently.
+            os.utime(cache_file)
+            cache_file = None
+        else:
+            msg = tree[0].headers
+            if all_headers:
+                tempmail.write(bytes(data[: tree[0].body_start]).rstrip(b"\r\n"))
+            else:
+                for header in DISPLAY_HEADERS:
+                    if header in msg:
+                        tempmail.write(f"{header}: {msg[header]}\n".encode())
+
+            tempmail.write(b"\n\n")
+
+            chunks = iter_decoded(data, msgpart)
             if wrap:
-                tempmail.write(wrapped(msgpart.get_payload(decode=True)))
+                text = iter_text(chunks, charset=msgpart.charset)
+                for line in iter_wrapped(text, width=width):
+                    tempmail.write(line.encode())
             else:
-                tempmail.write(msgpart.get_payload(decode=True))
+                for chunk in chunks:
+                    tempmail.write(chunk)
         tempmail.flush()
+        if cache_file is not None:
+            cache_view(config=config, view=tempmail.name, cache_file=cache_file)
         subprocess.run([config["EDITOR"], tempmail.name])
 
 
@@ -934,9 +3537,20 @@ def do_it_two_it(args):  # Shia LeBeouf!
         if args.action == "new":
             return do_new(config=config, template_number=args.template_number)
         elif args.action == "send":
-            return send(config=config, mailfile=args.mailfile)
+            timings = StageTimings() if args.timings else None
+            send(
+                config=config,
+                mailfile=args.mailfile,
+                use_async=args.use_async,
+                timings=timings,
+            )
+            return show_timings(timings)
         elif args.action == "send_all":
-            return send_all(config=config)
+            timings = StageTimings() if args.timings else None
+            send_all(
+                config=config, jobs=args.jobs, use_async=args.use_async, timings=timings
+            )
+            return show_timings(timings)
         elif args.action == "check":
             return check_email(config=config)
         elif args.action == "reply":
@@ -952,7 +3566,18 @@ def do_it_two_it(args):  # Shia LeBeouf!
         elif args.action == "update":
             return update()
         elif args.action == "list":
-            return list_messages(config=config)
+            return list_messages(
+                config=config,
+                show_ids=args.ids,
+                limit=args.limit,
+                offset=args.offset,
+                since=args.since,
+                until=args.until,
+                with_attachments=args.with_attachments,
+                jobs=args.jobs,
+            )
+        elif args.action == "parts":
+            return show_parts(config=config, mailnumber=args.mailnumber)
         elif args.action == "read":
             return read(
                 config=config,